@@ -1,6 +1,8 @@
 import asyncio
+import functools
 import inspect
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 
 import discord
@@ -10,27 +12,64 @@ import modules.analytics as ga
 import modules.imdb_connector as imdb
 import modules.picker as picker
 import modules.plex_connector as plex_connector
+import modules.recommendation_pool as recommendation_pool
 import modules.trakt_connector as trakt_connector
+import modules.transport as transport
 from modules import discord_utils, config_parser
+from modules.imdb_database import IMDbCacheDatabase
+from databases.base import SQLiteProfile
 from modules.library_database import PlexContentDatabase, Content
 from modules.logs import *
 
 config = config_parser.Config(app_name="PlexRecs", config_path="config.yaml")
 
+http_session = transport.build_session(pool_size=config.http.pool_size, timeout=config.http.timeout_seconds,
+                                       max_retries=config.http.max_retries, retry_backoff=config.http.retry_backoff)
+
+database_profile = SQLiteProfile(journal_mode=config.database.journal_mode,
+                                 synchronous=config.database.synchronous,
+                                 cache_size_mb=config.database.cache_size_mb,
+                                 mmap_size_mb=config.database.mmap_size_mb,
+                                 busy_timeout_ms=config.database.busy_timeout_ms,
+                                 pool_size=max(config.database.pool_size, config.extras.recommendation_workers + 1))
+
 analytics = ga.GoogleAnalytics(analytics_id='UA-174268200-1', anonymous_ip=True,
-                               do_not_track=not config.extras.allow_analytics)
+                               do_not_track=not config.extras.allow_analytics, session=http_session)
 
 plex = plex_connector.PlexConnector(url=config.plex.url, token=config.plex.token,
                                     server_name=config.plex.server_name,
                                     library_list=config.plex.libraries, tautulli_url=config.tautulli.url,
                                     tautulli_key=config.tautulli.api_key, analytics=analytics,
-                                    database=PlexContentDatabase("content.db"))
+                                    database=PlexContentDatabase("content.db", profile=database_profile),
+                                    sync_chunk_size=config.plex.sync_chunk_size,
+                                    full_rescan_interval_hours=config.plex.full_rescan_hours,
+                                    history_ttl_minutes=config.tautulli.history_ttl_minutes,
+                                    session=http_session,
+                                    scan_workers=config.plex.scan_workers,
+                                    fetch_page_size=config.plex.fetch_page_size)
+
+imdb.set_up_cache(database=IMDbCacheDatabase("imdb_cache.db", ttl_hours=config.imdb.cache_ttl_hours,
+                                             max_entries=config.imdb.cache_max_entries,
+                                             profile=database_profile))
+
+ready_recommendations = recommendation_pool.RecommendationPool(
+    size_per_type=config.extras.prewarmed_recommendations)
+
+plex.add_sync_listener(discord_utils.invalidate_embeds)
+plex.add_sync_listener(ready_recommendations.discard)
 
 trakt = trakt_connector.TraktConnector(username=config.trakt.username,
                                        client_id=config.trakt.client_id,
-                                       client_secret=config.trakt.client_secret, analytics=analytics)
+                                       client_secret=config.trakt.client_secret, analytics=analytics,
+                                       revalidate_minutes=config.trakt.list_revalidate_minutes,
+                                       session=http_session)
 trakt.store_public_lists(lists_dict=config.trakt.lists)
 
+# Blocking work (Plex, Tautulli, IMDb, Trakt, database) runs here, never on the Discord event loop
+recommendation_executor = ThreadPoolExecutor(max_workers=config.extras.recommendation_workers,
+                                             thread_name_prefix="recommendation")
+sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="library-sync")  # one sync at a time
+
 emoji_numbers = [u"1\u20e3", u"2\u20e3", u"3\u20e3", u"4\u20e3", u"5\u20e3"]
 
 
@@ -39,10 +78,22 @@ def error_and_analytics(error_message, function_name):
     analytics.event(event_category="Error", event_action=function_name, random_uuid_if_needed=True)
 
 
+def _run_with_database_session(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        plex.database.close()  # results are detached (and never expired, see SQLAlchemyDatabase), safe to hand back
+
+
+async def run_blocking(executor: ThreadPoolExecutor, func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor,
+                                      functools.partial(_run_with_database_session, func, *args, **kwargs))
+
+
 def find_rec(media_type: str, unwatched: bool = False, username: str = None, rating: float = None,
-             above: bool = True, trakt_list_name: str = None, attempts: int = 10):
+             above: bool = True, trakt_list_name: str = None):
     """
-    :param attempts:
     :param trakt_list_name:
     :param above:
     :param rating:
@@ -53,14 +104,12 @@ def find_rec(media_type: str, unwatched: bool = False, username: str = None, rat
     """
     try:
         if unwatched:
-            return picker.pick_unwatched(plex_connector=plex, username=username, media_type=media_type,
-                                         attempts=attempts)
+            return picker.pick_unwatched(plex_connector=plex, username=username, media_type=media_type)
         elif rating:
-            return picker.pick_with_rating(plex_connector=plex, media_type=media_type, rating=rating, above=above,
-                                           attempts=attempts)
+            return picker.pick_with_rating(plex_connector=plex, media_type=media_type, rating=rating, above=above)
         elif trakt_list_name:
             return picker.pick_from_trakt_list(trakt_connector=trakt, trakt_list_name=trakt_list_name,
-                                               plex_connector=plex, attempts=attempts)
+                                               plex_connector=plex, media_type=media_type)
         else:
             return picker.pick_random(plex_connector=plex, media_type=media_type)
     except Exception as e:
@@ -72,31 +121,51 @@ def make_recommendation(media_type: str, unwatched: bool = False, plex_username:
                         above: bool = True, trakt_list_name: str = None):
     if unwatched:
         if not plex_username:
-            return "Please include a Plex username"
+            return "Please include a Plex username", None, None
         recommendation = find_rec(media_type=media_type, unwatched=True, username=plex_username)
         if not recommendation:
             return "I couldn't find that Plex username", None, None
-        if recommendation == "Too many attempts":
-            return "Sorry, it took too long to find something for you", None, None
+        if recommendation == "No matches":
+            return "Looks like you've already seen everything!", None, None
     elif rating:
         recommendation = find_rec(media_type=media_type, rating=rating, above=above)
-        if recommendation == "Too many attempts":
-            return "Sorry, it took too long to find something for you", None, None
+        if recommendation == "No matches":
+            return "Sorry, I couldn't find anything with that rating", None, None
     elif trakt_list_name:
         recommendation = find_rec(media_type=media_type, trakt_list_name=trakt_list_name)
-        if recommendation == "Too many attempts":
-            return "Sorry, it took too long to find something for you", None, None
+        if recommendation == "No matches":
+            return "Sorry, nothing from that list is on Plex", None, None
     else:
+        ready = ready_recommendations.pop(media_type=media_type)
+        if ready:
+            recommendation, embed = ready
+            return f"How about {recommendation.Title}?", embed, recommendation
         recommendation = find_rec(media_type=media_type, unwatched=False)
+    if not recommendation:
+        return f"Sorry, I couldn't find a {media_type} to recommend right now", None, None
     embed = discord_utils.make_embed(plex=plex, media_item=recommendation, analytics=analytics)
     return f"How about {recommendation.Title}?", embed, recommendation
 
 
+def refill_ready_recommendations():
+    for media_type in plex.library_config.keys():
+        try:
+            ready_recommendations.refill(
+                media_type=media_type,
+                get_contents=lambda count: plex.get_random_media_items(media_type=media_type, count=count),
+                make_embed=lambda content: discord_utils.make_embed(plex=plex, media_item=content,
+                                                                    analytics=analytics))
+        except Exception as e:
+            error_and_analytics(error_message=f"Error refilling {media_type} recommendations: {e}",
+                                function_name=inspect.currentframe().f_code.co_name)
+
+
 class PlexRecs(commands.Cog):
 
     async def user_response(self, ctx, media_type: str, media_item: Content):
         if str(ctx.message.author.id) == str(config.discord.owner_id):
-            response, number_of_players = plex.get_available_players(media_type=media_type)
+            response, number_of_players = await run_blocking(recommendation_executor, plex.get_available_players,
+                                                             media_type=media_type)
             if response:
                 ask_about_player = True
                 while ask_about_player:
@@ -111,9 +180,11 @@ class PlexRecs(commands.Cog):
                         reaction, user = await self.bot.wait_for('reaction_add', timeout=60.0, check=check)
                         if reaction:
                             player_number = emoji_numbers.index(str(reaction.emoji))
-                            media_item = plex.get_full_media_item(content_media_item=media_item)
+                            media_item = await run_blocking(recommendation_executor, plex.get_full_media_item,
+                                                            content_media_item=media_item)
                             if media_item:
-                                plex.play_media(player_number, media_item)
+                                await run_blocking(recommendation_executor, plex.play_media, player_number,
+                                                   media_item)
                             else:
                                 await ctx.send(
                                     f"Sorry, something went wrong while loading that {media_type}.")
@@ -123,7 +194,45 @@ class PlexRecs(commands.Cog):
 
     @tasks.loop(minutes=60.0)  # update library every hour
     async def make_libraries(self):
-        plex.populate_libraries()
+        await run_blocking(sync_executor, plex.populate_libraries)
+
+    @tasks.loop(minutes=5.0)
+    async def enrich_ratings(self):
+        await run_blocking(sync_executor, plex.enrich_ratings, batch_size=config.imdb.rating_batch_size)
+
+    @tasks.loop(seconds=30.0)
+    async def refill_recommendations(self):
+        await run_blocking(recommendation_executor, refill_ready_recommendations)
+
+    @refill_recommendations.before_loop
+    async def before_refill_recommendations(self):
+        await asyncio.sleep(60)  # let the first library sync get going
+
+    @tasks.loop(count=1)
+    async def warm_trakt_lists(self):
+        await run_blocking(recommendation_executor, trakt.warm_list_snapshots)
+
+    @commands.command(name="rescan")
+    async def rescan_libraries(self, ctx: commands.Context):
+        """
+        Re-walk every Plex library instead of only fetching what changed (owner only)
+        """
+        if str(ctx.message.author.id) != str(config.discord.owner_id):
+            return
+        hold_message = await ctx.send("Rescanning Plex libraries...")
+        await run_blocking(sync_executor, plex.populate_libraries, full_rescan=True)
+        await hold_message.delete()
+        await ctx.send("Finished rescanning Plex libraries.")
+
+    @commands.command(name="recstats")
+    async def recommendation_stats(self, ctx: commands.Context):
+        """
+        Show how often recommendations were served from the ready pool (owner only)
+        """
+        if str(ctx.message.author.id) != str(config.discord.owner_id):
+            return
+        stats = ready_recommendations.stats()
+        await ctx.send("\n".join(f"{key}: {value}" for key, value in stats.items()))
 
     @commands.group(aliases=['recommend', 'suggest', 'rec', 'sugg'], pass_context=True)
     async def plex_rec(self, ctx: commands.Context, media_type: str):
@@ -158,7 +267,8 @@ class PlexRecs(commands.Cog):
                     "Looking for a{} {}...".format("n" if (media_type[0] in ['a', 'e', 'i', 'o', 'u']) else "",
                                                    media_type))
                 async with ctx.typing():
-                    response, embed, media_item = make_recommendation(media_type, False, None)
+                    response, embed, media_item = await run_blocking(recommendation_executor, make_recommendation,
+                                                                     media_type, False, None)
                 await hold_message.delete()
                 if embed is not None:
                     await ctx.send(response, embed=embed)
@@ -189,7 +299,8 @@ class PlexRecs(commands.Cog):
         else:
             hold_message = await ctx.send(f"Looking for a new {media_type}...")
             async with ctx.typing():
-                response, embed, media_item = make_recommendation(media_type, True, plex_username)
+                response, embed, media_item = await run_blocking(recommendation_executor, make_recommendation,
+                                                                 media_type, True, plex_username)
             await hold_message.delete()
             if embed is not None:
                 await ctx.send(response, embed=embed)
@@ -219,8 +330,8 @@ class PlexRecs(commands.Cog):
         else:
             hold_message = await ctx.send(f"Looking for a {media_type} that's rated at least {rating} on IMDb...")
             async with ctx.typing():
-                response, embed, media_item = make_recommendation(media_type=media_type, rating=float(rating),
-                                                                  above=True)
+                response, embed, media_item = await run_blocking(recommendation_executor, make_recommendation,
+                                                                 media_type=media_type, rating=float(rating), above=True)
             await hold_message.delete()
             if embed is not None:
                 await ctx.send(response, embed=embed)
@@ -250,8 +361,9 @@ class PlexRecs(commands.Cog):
         else:
             hold_message = await ctx.send(f"Looking for a {media_type} that's rated less than {rating} on IMDb...")
             async with ctx.typing():
-                response, embed, media_item = make_recommendation(media_type=media_type, rating=float(rating),
-                                                                  above=False)
+                response, embed, media_item = await run_blocking(recommendation_executor, make_recommendation,
+                                                                 media_type=media_type, rating=float(rating),
+                                                                 above=False)
             await hold_message.delete()
             if embed is not None:
                 await ctx.send(response, embed=embed)
@@ -270,8 +382,8 @@ class PlexRecs(commands.Cog):
         """
         Get a movie or show from a specific Trakt.tv list
 
-        Heads up: Large Trakt list may take a while to parse, and your request may time out.
-        Once a choice is made from Trakt, the item is searched for in your Plex library. False matches are possible.
+        Lists are kept locally and only downloaded again when they change on Trakt.
+        List items are matched to your Plex library by their IMDb, TMDB and TVDB IDs.
         """
         media_type = None
         for group in plex.library_config.keys():
@@ -283,7 +395,8 @@ class PlexRecs(commands.Cog):
         else:
             hold_message = await ctx.send(f"Looking for a {media_type} from the '{list_name}' list on Trakt.tv")
             async with ctx.typing():
-                response, embed, media_item = make_recommendation(media_type=media_type, trakt_list_name=list_name)
+                response, embed, media_item = await run_blocking(recommendation_executor, make_recommendation,
+                                                                 media_type=media_type, trakt_list_name=list_name)
             await hold_message.delete()
             if embed is not None:
                 await ctx.send(response, embed=embed)
@@ -302,6 +415,11 @@ class PlexRecs(commands.Cog):
         analytics.event(event_category="Platform", event_action=sys.platform)
         info("Updating Plex libraries...")
         self.make_libraries.start()
+        self.enrich_ratings.change_interval(minutes=config.imdb.rating_interval_minutes)
+        self.enrich_ratings.start()
+        self.warm_trakt_lists.start()
+        if ready_recommendations.size_per_type > 0:
+            self.refill_recommendations.start()
 
 
 def setup(bot):
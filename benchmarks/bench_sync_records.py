@@ -0,0 +1,110 @@
+"""
+Compare the old per-item sync objects with ContentRecord on a synthetic library.
+
+Old path: a SmallMediaItem, then a dict of it, then an ORM Content object per item, written through the session.
+New path: one ContentRecord per item, staged with stage_content (Core upserts, no ORM objects) and merged with
+apply_staged_sync, as a library sync writes them.
+
+Usage: python benchmarks/bench_sync_records.py [item count]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.library_database import Content, ContentRecord, ExternalIDs, PlexContentDatabase  # noqa: E402
+from modules.plex_connector import SmallMediaItem  # noqa: E402
+
+CHUNK_SIZE = 500
+
+
+def _synthetic_item(number: int) -> dict:
+    return {'title': f"Synthetic Movie {number}", 'year': 1950 + number % 70, 'rating_key': number + 1,
+            'library_section_id': 1, 'media_type': 'movie',
+            'external_ids': [f"imdb://tt{number:07d}", f"tmdb://{number}"], 'updated_at': 1600000000 + number}
+
+
+def _legacy_objects(items: list) -> list:
+    objects = []
+    for item in items:
+        small_media_item = SmallMediaItem(title=item['title'], year=item['year'], rating_key=item['rating_key'],
+                                          library_section_id=item['library_section_id'],
+                                          media_type=item['media_type'], external_ids=list(item['external_ids']))
+        as_dict = {'title': small_media_item.title, 'year': small_media_item.year,
+                   'rating_key': small_media_item.rating_key,
+                   'library_section_id': small_media_item.library_section_id,
+                   'media_type': small_media_item.type, 'external_ids': small_media_item.external_ids}
+        objects.append((as_dict, Content(title=as_dict['title'], year=as_dict['year'],
+                                         rating_key=as_dict['rating_key'],
+                                         library_section_id=as_dict['library_section_id'],
+                                         media_type=as_dict['media_type'], on_plex=True)))
+    return objects
+
+
+def _records(items: list) -> list:
+    return [ContentRecord(title=item['title'], year=item['year'], rating_key=item['rating_key'],
+                          library_section_id=item['library_section_id'], media_type=item['media_type'],
+                          external_ids=tuple(item['external_ids']), updated_at=item['updated_at'])
+            for item in items]
+
+
+def _measure_build(build, items: list):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    built = build(items)
+    elapsed = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return built, elapsed, peak
+
+
+def _write_legacy(database: PlexContentDatabase, objects: list):
+    for start in range(0, len(objects), CHUNK_SIZE):
+        chunk = objects[start:start + CHUNK_SIZE]
+        database.session.add_all([content for _, content in chunk])
+        database.session.flush()
+        database.session.add_all([ExternalIDs(content_id=content.ID, external_id=external_id)
+                                  for as_dict, content in chunk for external_id in as_dict['external_ids']])
+        database.commit()
+
+
+def _write_records(database: PlexContentDatabase, records: list):
+    database.begin_staged_sync()
+    for start in range(0, len(records), CHUNK_SIZE):
+        database.stage_content(contents=records[start:start + CHUNK_SIZE])
+    database.apply_staged_sync()
+
+
+def _measure_write(write, built) -> float:
+    with tempfile.TemporaryDirectory() as folder:
+        database = PlexContentDatabase(os.path.join(folder, "bench.db"))
+        start_time = time.perf_counter()
+        write(database, built)
+        elapsed = time.perf_counter() - start_time
+        database.close()
+        database.engine.dispose()
+    return elapsed
+
+
+def main(count: int = 100000):
+    items = [_synthetic_item(number) for number in range(count)]
+    results = []
+    for name, build, write in [("SmallMediaItem + dict + ORM", _legacy_objects, _write_legacy),
+                               ("ContentRecord + staged merge", _records, _write_records)]:
+        built, build_seconds, peak_bytes = _measure_build(build=build, items=items)
+        write_seconds = _measure_write(write=write, built=built)
+        results.append((name, build_seconds, peak_bytes, write_seconds))
+        del built
+
+    print(f"{count} synthetic items, chunks of {CHUNK_SIZE}")
+    print(f"{'path':<30}{'build s':>10}{'peak MiB':>10}{'write s':>10}{'rows/s':>10}")
+    for name, build_seconds, peak_bytes, write_seconds in results:
+        print(f"{name:<30}{build_seconds:>10.2f}{peak_bytes / 2 ** 20:>10.1f}{write_seconds:>10.2f}"
+              f"{count / write_seconds:>10.0f}")
+
+
+if __name__ == '__main__':
+    main(count=int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
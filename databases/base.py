@@ -1,10 +1,13 @@
+import os
+import threading
+from contextlib import contextmanager
 from functools import wraps
-from typing import List
+from typing import Callable, List, NamedTuple
 
-from sqlalchemy import create_engine, MetaData, null
-from sqlalchemy_utils import database_exists, create_database
+from sqlalchemy import create_engine, event, inspect, MetaData, null, Column, Table
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Query
+from sqlalchemy.orm import sessionmaker, scoped_session, Query
+from sqlalchemy.pool import QueuePool
 
 
 def none_as_null(func):
@@ -49,10 +52,29 @@ def false_if_error(func):
     return wrapper
 
 
+class SQLiteProfile(NamedTuple):
+    """
+    Connection settings applied to every new SQLite connection
+    """
+    journal_mode: str = 'WAL'  # readers and the writer don't block each other
+    synchronous: str = 'NORMAL'  # safe with WAL, only the last commits can be lost on power failure
+    cache_size_mb: int = 64
+    mmap_size_mb: int = 256
+    busy_timeout_ms: int = 5000  # wait for a competing writer instead of failing with "database is locked"
+    temp_store: str = 'MEMORY'
+    pool_size: int = 5  # connections kept open, one per concurrently working thread
+
+
+DEFAULT_SQLITE_PROFILE = SQLiteProfile()
+
+
 class SQLAlchemyDatabase:
     def __init__(self,
-                 sqlite_file: str):
+                 sqlite_file: str,
+                 profile: SQLiteProfile = None):
         self.sqlite_file = sqlite_file
+        self.profile = profile or DEFAULT_SQLITE_PROFILE
+        self._local = threading.local()  # transaction depth, per thread like the sessions
 
         self.engine = None
         self.base = None
@@ -63,31 +85,138 @@ class SQLAlchemyDatabase:
 
         self.setup()
 
+    @property
+    def _transaction_depth(self) -> int:
+        return getattr(self._local, 'transaction_depth', 0)
+
     def commit(self):
+        """
+        Commit the calling thread's session, deferred to the end of the outermost transaction() block if in one
+        """
+        if self._transaction_depth:
+            return
         self.session.commit()
 
+    @contextmanager
+    def transaction(self):
+        """
+        Group writes into one unit of work: helpers called inside don't commit, everything is committed
+        once at the end or rolled back if the block raises.
+        Nested blocks are savepoints, so an inner block can fail and be rolled back on its own.
+
+        with database.transaction():
+            database.add_library(...)
+            with database.transaction():
+                database.set_external_ids_for_content(...)
+
+        :return: the session
+        """
+        depth = self._transaction_depth
+        if depth == 0:
+            dbapi_connection = self.session.connection().connection
+            if not dbapi_connection.in_transaction:
+                # Take the write lock up front (waiting up to busy_timeout), rather than failing to upgrade
+                # a read transaction later. Also stops pysqlite letting the first SAVEPOINT start, and its
+                # RELEASE commit, the transaction.
+                dbapi_connection.execute('BEGIN IMMEDIATE')
+            nested = None
+        else:
+            nested = self.session.begin_nested()
+        self._local.transaction_depth = depth + 1
+        try:
+            yield self.session
+            if nested:
+                nested.commit()
+        except BaseException:
+            if nested:
+                nested.rollback()
+            else:
+                self.session.rollback()
+            raise
+        finally:
+            self._local.transaction_depth = depth
+        if not nested:
+            self.session.commit()
+
     def close(self):
-        self.session.close()
+        """
+        Close the calling thread's session, the next use starts a new one
+        """
+        self.session.remove()
 
     def setup(self):
         if not self.url:
             return
 
-        self.engine = create_engine(self.url)
+        folder = os.path.dirname(self.sqlite_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)  # SQLite creates the file itself on first connect
+
+        self.engine = create_engine(self.url,
+                                    poolclass=QueuePool,
+                                    pool_size=self.profile.pool_size,
+                                    max_overflow=self.profile.pool_size * 2,
+                                    # connections move between threads through the pool, never shared at once
+                                    connect_args={'check_same_thread': False,
+                                                  'timeout': self.profile.busy_timeout_ms / 1000})
 
         if not self.engine:
             return
-
-        if not database_exists(self.engine.url):
-            create_database(self.engine.url)
+        event.listen(self.engine, 'connect', self._configure_connection)
 
         self.base = declarative_base(bind=self.engine)
         self.meta = MetaData()
         self.meta.create_all(self.engine)
 
-        Session = sessionmaker()
+        # Objects are handed to other threads after their session is closed, so a commit mustn't expire them
+        Session = sessionmaker(expire_on_commit=False)
         Session.configure(bind=self.engine)
-        self.session = Session()
+        # One session per thread, so worker threads can share this database object
+        self.session = scoped_session(Session)
+
+    def _configure_connection(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f'PRAGMA journal_mode = {self.profile.journal_mode}')
+            cursor.execute(f'PRAGMA synchronous = {self.profile.synchronous}')
+            cursor.execute(f'PRAGMA cache_size = {-int(self.profile.cache_size_mb) * 1024}')  # negative is KiB
+            cursor.execute(f'PRAGMA mmap_size = {int(self.profile.mmap_size_mb) * 1024 * 1024}')
+            cursor.execute(f'PRAGMA busy_timeout = {int(self.profile.busy_timeout_ms)}')
+            cursor.execute(f'PRAGMA temp_store = {self.profile.temp_store}')
+        finally:
+            cursor.close()
+
+    def add_column_if_missing(self, table: Table, column: Column):
+        """
+        Add a column to an existing table (tables created by an older version won't have it)
+        """
+        existing_columns = [c['name'] for c in inspect(self.engine).get_columns(table.name)]
+        if column.name in existing_columns:
+            return
+        column_type = column.type.compile(dialect=self.engine.dialect)
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}')
+
+    def get_schema_version(self) -> int:
+        with self.engine.connect() as connection:
+            return connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+    def set_schema_version(self, version: int):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(f'PRAGMA user_version = {int(version)}')
+
+    def migrate(self, migrations: List[Callable]):
+        """
+        Upgrade the database in place, running each migration newer than the stored schema version in order
+
+        :param migrations: functions taking this database, migration N upgrades the schema to version N
+        """
+        current_version = self.get_schema_version()
+        for version, migration in enumerate(migrations, start=1):
+            if version <= current_version:
+                continue
+            migration(self)
+            self.set_schema_version(version)
 
     def get_first_entry(self, table_schema):
         return self.session.query(table_schema).first()
@@ -112,6 +241,7 @@ class SQLAlchemyDatabase:
     def create_entry(self, table_schema, **kwargs):
         entry = table_schema(**kwargs)
         self.session.add(entry)
+        self.session.flush()  # assigns the ID now, the commit may be deferred by transaction()
         self.commit()
         return entry
 
@@ -1,8 +1,17 @@
+import atexit
+import queue
+import threading
+import time
 import urllib
 import uuid
 
 import requests
 
+from modules.logs import *
+
+_BATCH_URL = "https://www.google-analytics.com/batch"
+_MAX_HITS_PER_BATCH = 20  # Measurement Protocol limit
+
 
 def _time_uuid():
     return uuid.uuid1()
@@ -25,26 +34,100 @@ def _verify_params(params_needed, **included_params):
     return True
 
 
-def _make_url(params_dict):
-    base_url = "https://www.google-analytics.com/collect"
-    args = urllib.parse.urlencode(params_dict)
-    return f"{base_url}?{args}"
+def _make_payload(params_dict):
+    return urllib.parse.urlencode(params_dict)
 
 
 class GoogleAnalytics:
-    def __init__(self, analytics_id: str, anonymous_ip: bool = False, do_not_track: bool = False):
+    def __init__(self, analytics_id: str, anonymous_ip: bool = False, do_not_track: bool = False,
+                 session: requests.Session = None, queue_size: int = 1000, flush_interval_seconds: float = 30):
         self.analytics_id = analytics_id
+        self.session = session or requests.Session()
         self.version = '1'
         self.anonymize_ip = anonymous_ip
         self.do_not_track = do_not_track
+        self.flush_interval_seconds = flush_interval_seconds
+        self.dropped_hits = 0
+        self._hits = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def _start_worker(self):
+        with self._worker_lock:
+            if self._worker:
+                return
+            self._worker = threading.Thread(target=self._run, name="analytics", daemon=True)
+            self._worker.start()
+            atexit.register(self.close)
+
+    def _post_batch(self, payloads):
+        try:
+            self.session.post(url=_BATCH_URL, data="\n".join(payloads))
+        except Exception as e:
+            debug(f"Could not send {len(payloads)} analytics hits: {e}")
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval_seconds
+        while True:
+            try:
+                hit = self._hits.get(timeout=max(0.0, deadline - time.monotonic()))
+                if hit is not None:
+                    batch.append(hit)
+            except queue.Empty:
+                pass
+            stopping = self._stop.is_set()
+            if len(batch) >= _MAX_HITS_PER_BATCH or time.monotonic() >= deadline or stopping:
+                if stopping:  # drain whatever is left before exiting
+                    while True:
+                        try:
+                            hit = self._hits.get_nowait()
+                        except queue.Empty:
+                            break
+                        if hit is not None:
+                            batch.append(hit)
+                for start in range(0, len(batch), _MAX_HITS_PER_BATCH):
+                    self._post_batch(payloads=batch[start:start + _MAX_HITS_PER_BATCH])
+                batch = []
+                deadline = time.monotonic() + self.flush_interval_seconds
+                if stopping:
+                    return
+
+    def close(self, timeout: float = 5):
+        """
+        Send any queued hits and stop the background sender
+
+        :param timeout: seconds to wait for the last batches to go out
+        :return:
+        """
+        if not self._worker:
+            return
+        self._stop.set()
+        try:
+            self._hits.put_nowait(None)  # wake the worker up
+        except queue.Full:
+            pass
+        self._worker.join(timeout=timeout)
 
     def _send(self, final_params):
+        """
+        Queue a hit for the background sender, never blocks on the network
+
+        :param final_params:
+        :return: False if the queue is full and the hit was dropped
+        """
         if self.do_not_track:
             return True
-        url = _make_url(params_dict=final_params)
-        if requests.post(url=url):
+        if self._stop.is_set():
+            return False
+        self._start_worker()
+        try:
+            self._hits.put_nowait(_make_payload(params_dict=final_params))
             return True
-        return False
+        except queue.Full:
+            self.dropped_hits += 1
+            return False
 
     def event(self, event_category: str, event_action: str,
               event_label: str = None, event_value: int = None, user_id: str = None,
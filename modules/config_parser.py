@@ -15,6 +15,24 @@ def _extract_bool(value):
         raise ValueError("Not a boolean: {}".format(value))
 
 
+def _extract_int(value):
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("Not an integer: {}".format(value))
+
+
+def _extract_float(value):
+    if isinstance(value, float):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Not a number: {}".format(value))
+
+
 class ConfigSection:
     def __init__(self, section_key: str, data, parent_key: str = None, pull_from_env: bool = True):
         self.section_key = section_key
@@ -69,6 +87,26 @@ class PlexConfig(ConfigSection):
     def use_plex_link(self) -> bool:
         return self._get_value(key="UsePlexLink", default=True, env_name_override="PR_USE_PLEX_LINK")
 
+    @property
+    def sync_chunk_size(self) -> int:
+        value = self._get_value(key="SyncChunkSize", default=500, env_name_override="PR_PLEX_SYNC_CHUNK_SIZE")
+        return _extract_int(value)
+
+    @property
+    def full_rescan_hours(self) -> int:
+        value = self._get_value(key="FullRescanHours", default=24, env_name_override="PR_PLEX_FULL_RESCAN_HOURS")
+        return _extract_int(value)
+
+    @property
+    def fetch_page_size(self) -> int:
+        value = self._get_value(key="FetchPageSize", default=1000, env_name_override="PR_PLEX_FETCH_PAGE_SIZE")
+        return _extract_int(value)
+
+    @property
+    def scan_workers(self) -> int:
+        value = self._get_value(key="ScanWorkers", default=4, env_name_override="PR_PLEX_SCAN_WORKERS")
+        return _extract_int(value)
+
     @property
     def _libraries_section(self):
         return self._get_subsection(key="Libraries")
@@ -136,6 +174,96 @@ class TautulliConfig(ConfigSection):
     def url(self) -> str:
         return self._get_value(key="URL", env_name_override="PR_TAUTULLI_URL")
 
+    @property
+    def history_ttl_minutes(self) -> int:
+        value = self._get_value(key="HistoryTTLMinutes", default=10,
+                                env_name_override="PR_TAUTULLI_HISTORY_TTL_MINUTES")
+        return _extract_int(value)
+
+
+class IMDbConfig(ConfigSection):
+    def __init__(self, data, pull_from_env: bool = True):
+        super().__init__(section_key="IMDb", data=data, pull_from_env=pull_from_env)
+
+    @property
+    def cache_ttl_hours(self) -> int:
+        value = self._get_value(key="CacheTTLHours", default=168, env_name_override="PR_IMDB_CACHE_TTL_HOURS")
+        return _extract_int(value)
+
+    @property
+    def cache_max_entries(self) -> int:
+        value = self._get_value(key="CacheMaxEntries", default=10000, env_name_override="PR_IMDB_CACHE_MAX_ENTRIES")
+        return _extract_int(value)
+
+    @property
+    def rating_batch_size(self) -> int:
+        value = self._get_value(key="RatingBatchSize", default=20, env_name_override="PR_IMDB_RATING_BATCH_SIZE")
+        return _extract_int(value)
+
+    @property
+    def rating_interval_minutes(self) -> float:
+        value = self._get_value(key="RatingIntervalMinutes", default=5,
+                                env_name_override="PR_IMDB_RATING_INTERVAL_MINUTES")
+        return _extract_float(value)
+
+
+class DatabaseConfig(ConfigSection):
+    def __init__(self, data, pull_from_env: bool = True):
+        super().__init__(section_key="Database", data=data, pull_from_env=pull_from_env)
+
+    @property
+    def journal_mode(self) -> str:
+        return self._get_value(key="JournalMode", default="WAL", env_name_override="PR_DATABASE_JOURNAL_MODE")
+
+    @property
+    def synchronous(self) -> str:
+        return self._get_value(key="Synchronous", default="NORMAL", env_name_override="PR_DATABASE_SYNCHRONOUS")
+
+    @property
+    def cache_size_mb(self) -> int:
+        value = self._get_value(key="CacheSizeMB", default=64, env_name_override="PR_DATABASE_CACHE_SIZE_MB")
+        return _extract_int(value)
+
+    @property
+    def mmap_size_mb(self) -> int:
+        value = self._get_value(key="MmapSizeMB", default=256, env_name_override="PR_DATABASE_MMAP_SIZE_MB")
+        return _extract_int(value)
+
+    @property
+    def busy_timeout_ms(self) -> int:
+        value = self._get_value(key="BusyTimeoutMS", default=5000, env_name_override="PR_DATABASE_BUSY_TIMEOUT_MS")
+        return _extract_int(value)
+
+    @property
+    def pool_size(self) -> int:
+        value = self._get_value(key="PoolSize", default=5, env_name_override="PR_DATABASE_POOL_SIZE")
+        return _extract_int(value)
+
+
+class HTTPConfig(ConfigSection):
+    def __init__(self, data, pull_from_env: bool = True):
+        super().__init__(section_key="HTTP", data=data, pull_from_env=pull_from_env)
+
+    @property
+    def pool_size(self) -> int:
+        value = self._get_value(key="PoolSize", default=10, env_name_override="PR_HTTP_POOL_SIZE")
+        return _extract_int(value)
+
+    @property
+    def timeout_seconds(self) -> float:
+        value = self._get_value(key="TimeoutSeconds", default=30, env_name_override="PR_HTTP_TIMEOUT_SECONDS")
+        return _extract_float(value)
+
+    @property
+    def max_retries(self) -> int:
+        value = self._get_value(key="MaxRetries", default=3, env_name_override="PR_HTTP_MAX_RETRIES")
+        return _extract_int(value)
+
+    @property
+    def retry_backoff(self) -> float:
+        value = self._get_value(key="RetryBackoff", default=0.5, env_name_override="PR_HTTP_RETRY_BACKOFF")
+        return _extract_float(value)
+
 
 class DiscordConfig(ConfigSection):
     def __init__(self, data, pull_from_env: bool = True):
@@ -170,6 +298,12 @@ class TraktConfig(ConfigSection):
     def client_secret(self) -> str:
         return self._get_value(key="ClientSecret", env_name_override="PR_TRAKT_CLIENT_SECRET")
 
+    @property
+    def list_revalidate_minutes(self) -> int:
+        value = self._get_value(key="ListRevalidateMinutes", default=15,
+                                env_name_override="PR_TRAKT_LIST_REVALIDATE_MINUTES")
+        return _extract_int(value)
+
     @property
     def lists(self) -> Dict:
         data = self._get_value(key="Lists", default=[], env_name_override="PR_TRAKT_LISTS")
@@ -205,6 +339,23 @@ class ExtrasConfig(ConfigSection):
                                 env_name_override="PR_ALLOW_ANALYTICS")
         return _extract_bool(value)
 
+    @property
+    def recommendation_workers(self) -> int:
+        value = self._get_value(key="RecommendationWorkers", default=4,
+                                env_name_override="PR_RECOMMENDATION_WORKERS")
+        return _extract_int(value)
+
+    @property
+    def prewarmed_recommendations(self) -> int:
+        value = self._get_value(key="PrewarmedRecommendations", default=5,
+                                env_name_override="PR_PREWARMED_RECOMMENDATIONS")
+        return _extract_int(value)
+
+    @property
+    def embed_cache_size(self) -> int:
+        value = self._get_value(key="EmbedCacheSize", default=1000, env_name_override="PR_EMBED_CACHE_SIZE")
+        return _extract_int(value)
+
     @property
     def suppress_logs(self) -> bool:
         value = self._get_value(key="SuppressLogs", default=False,
@@ -226,6 +377,9 @@ class Config:
 
         self.plex = PlexConfig(data=self.config, pull_from_env=self.pull_from_env)
         self.tautulli = TautulliConfig(self.config, self.pull_from_env)
+        self.imdb = IMDbConfig(self.config, self.pull_from_env)
+        self.http = HTTPConfig(self.config, self.pull_from_env)
+        self.database = DatabaseConfig(self.config, self.pull_from_env)
         self.discord = DiscordConfig(self.config, self.pull_from_env)
         self.trakt = TraktConfig(self.config, self.pull_from_env)
         self.extras = ExtrasConfig(self.config, self.pull_from_env)
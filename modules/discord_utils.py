@@ -1,19 +1,38 @@
 import discord
 from discord.ext import commands, tasks
 
+from typing import Iterable
+
 import modules.imdb_connector as imdb
 from modules import plex_connector, config_parser
 from modules.analytics import GoogleAnalytics
+from modules.cache import LRUCache
 from modules.library_database import Content
 from modules.plex_connector import PlexConnector
 
 config = config_parser.Config(app_name="PlexRecs", config_path="config.yaml")
 
+_embeds = LRUCache(max_size=config.extras.embed_cache_size)  # rating key -> Embed.to_dict()
+
+
+def invalidate_embeds(rating_keys: Iterable[int]):
+    """
+    Drop cached embeds for items a library sync changed or removed
+    """
+    for rating_key in rating_keys:
+        _embeds.invalidate(rating_key)
+
 
 def make_embed(plex: PlexConnector, media_item: Content, analytics: GoogleAnalytics):
-    imdb_item = imdb.get_imdb_item(media_item.Title, analytics=analytics)
+    cached_embed = _embeds.get(media_item.RatingKey)
+    if cached_embed:
+        return discord.Embed.from_dict(cached_embed)  # a copy, callers are free to change it
+    imdb_item = imdb.get_imdb_item(media_item.Title, year=media_item.Year, analytics=analytics)
+    if not imdb_item:
+        # Not cached, so the lookup is retried next time
+        imdb_item = imdb.IMDbRecord(imdb_id=None)
     embed = None
-    if config.plex.use_plex_link:
+    if config.plex.use_plex_link or not imdb_item.imdb_id:
         url = f"https://app.plex.tv/desktop#!/server/{plex.server_id}/details?key=%2Flibrary%2Fmetadata%2F{media_item.RatingKey}"
         embed = discord.Embed(title=media_item.Title,
                               url=url,
@@ -29,7 +48,9 @@ def make_embed(plex: PlexConnector, media_item: Content, analytics: GoogleAnalyt
     embed.add_field(name="Release Date", value=imdb_item.release_date, inline=False)
     if media_item.MediaType not in ['artist', 'album', 'track']:
         try:
-            embed.set_image(url=str(imdb_item.image.url))
+            embed.set_image(url=str(imdb_item.image_url))
         except:
             pass
+    if imdb_item.imdb_id:
+        _embeds.set(media_item.RatingKey, embed.to_dict())
     return embed
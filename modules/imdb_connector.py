@@ -1,27 +1,141 @@
+from typing import List, NamedTuple, Optional
+
 import imdb
 
+from modules.cache import LRUCache
+from modules.imdb_database import IMDbCacheDatabase, IMDbItem
 from modules.logs import *
 
 im = imdb.IMDb()
 
+_NO_MATCH = ''  # cached search result when IMDb had nothing for a title/year
+
+
+class IMDbRecord(NamedTuple):
+    imdb_id: str
+    title: str = None
+    year: int = None
+    rating: float = None
+    votes: int = None
+    plot_outline: str = None
+    release_date: str = None
+    image_url: str = None
+
+
+class _IMDbCache:
+    def __init__(self):
+        self.memory = LRUCache(max_size=1000)
+        self.database: Optional[IMDbCacheDatabase] = None
+
+
+_cache = _IMDbCache()
+
+
+def set_up_cache(database: IMDbCacheDatabase, memory_size: int = 1000):
+    """
+    Back IMDb lookups with a persistent cache
+    """
+    _cache.database = database
+    _cache.memory = LRUCache(max_size=memory_size, ttl_seconds=database.ttl_seconds)
+
 
-def get_imdb_item(title, analytics):
+def _record_from_cached_item(item: IMDbItem) -> IMDbRecord:
+    return IMDbRecord(imdb_id=item.IMDbID, title=item.Title, year=item.Year, rating=item.Rating, votes=item.Votes,
+                      plot_outline=item.PlotOutline, release_date=item.ReleaseDate, image_url=item.ImageURL)
+
+
+def _record_from_movie(movie) -> IMDbRecord:
+    plot_outline = movie.get('plot outline')
+    if not plot_outline and movie.get('plot'):
+        plot_outline = movie['plot'][0].split('::')[0]  # strip the author
+    return IMDbRecord(imdb_id=f"tt{movie.movieID}",
+                      title=movie.get('title'),
+                      year=movie.get('year'),
+                      rating=movie.get('rating'),
+                      votes=movie.get('votes'),
+                      plot_outline=plot_outline,
+                      release_date=movie.get('original air date'),
+                      image_url=movie.get('full-size cover url') or movie.get('cover url'))
+
+
+def _remember(record: IMDbRecord):
+    _cache.memory.set(record.imdb_id, record)
+    if _cache.database:
+        _cache.database.store_item(**record._asdict())
+
+
+def get_imdb_item_by_id(imdb_id: str, analytics=None, raise_errors: bool = False) -> Optional[IMDbRecord]:
+    """
+    Get an IMDb item by its ID (i.e. 'tt0111161'), from the cache if possible
+
+    :param imdb_id:
+    :param analytics:
+    :param raise_errors: re-raise lookup errors, rather than returning None as if there was no such item
+    :return:
+    """
+    record = _cache.memory.get(imdb_id)
+    if record:
+        return record
+    if _cache.database:
+        cached_item = _cache.database.get_item(imdb_id=imdb_id)
+        if cached_item:
+            record = _record_from_cached_item(item=cached_item)
+            _cache.memory.set(imdb_id, record)
+            return record
     try:
-        search_results = im.search_for_title(title)
-        if search_results:
-            return im.get_title(search_results[0].imdb_id)
+        record = _record_from_movie(movie=im.get_movie(imdb_id.replace('tt', '')))
+        _remember(record=record)
+        return record
     except Exception as e:
         error(f"Could not get IMDb item: {e}")
-        analytics.event(event_category="Error", event_action='get_imdb_item', random_uuid_if_needed=True)
+        if analytics:
+            analytics.event(event_category="Error", event_action='get_imdb_item_by_id', random_uuid_if_needed=True)
+        if raise_errors:
+            raise
     return None
 
 
-def build_ids_dict(ids):
-    ids_dict = {}
-    if ids.get('imdb'):
-        ids_dict['imdb'] = ids['imdb']
-    if ids.get('tvdb'):
-        ids_dict['thetvdb'] = ids['tvdb']
-    if ids.get('tmdb'):
-        ids_dict['themoviedb'] = ids['tmdb']
-    return ids_dict
+def get_imdb_item(title, year: int = None, analytics=None, raise_errors: bool = False) -> Optional[IMDbRecord]:
+    """
+    Get the IMDb item best matching a title and year, from the cache if possible
+
+    :param title:
+    :param year:
+    :param analytics:
+    :param raise_errors: re-raise lookup errors, rather than returning None as if nothing matched
+    :return:
+    """
+    search_key = (title, year)
+    imdb_id = _cache.memory.get(search_key)
+    if imdb_id is None and _cache.database:
+        cached_search = _cache.database.get_search(title=title, year=year)
+        if cached_search:
+            imdb_id = cached_search.IMDbID or _NO_MATCH
+    if imdb_id is None:
+        try:
+            search_results = im.search_movie(title)
+            if year:
+                # prefer the result from the right year
+                search_results = sorted(search_results, key=lambda movie: movie.get('year') != year)
+            imdb_id = f"tt{search_results[0].movieID}" if search_results else None
+            if _cache.database:
+                _cache.database.store_search(title=title, year=year, imdb_id=imdb_id)
+        except Exception as e:
+            error(f"Could not get IMDb item: {e}")
+            if analytics:
+                analytics.event(event_category="Error", event_action='get_imdb_item', random_uuid_if_needed=True)
+            if raise_errors:
+                raise
+            return None
+        imdb_id = imdb_id or _NO_MATCH
+    _cache.memory.set(search_key, imdb_id)
+    if imdb_id == _NO_MATCH:
+        return None  # searched recently, nothing found
+    return get_imdb_item_by_id(imdb_id=imdb_id, analytics=analytics, raise_errors=raise_errors)
+
+
+def build_guids(ids) -> List[str]:
+    """
+    Convert Trakt IDs to Plex GUIDs (i.e. 'imdb://tt0111161', 'tmdb://278', 'tvdb://81189')
+    """
+    return [f"{source}://{ids[source]}" for source in ['imdb', 'tmdb', 'tvdb'] if ids.get(source)]
@@ -0,0 +1,146 @@
+import time
+from typing import Optional
+
+from sqlalchemy import Column, Integer, String, BigInteger, Float, Text, func
+from sqlalchemy.ext.declarative import declarative_base
+
+import databases.base as db
+
+Base = declarative_base()
+
+ACCESS_TIME_RESOLUTION_SECONDS = 3600  # eviction order only needs to be roughly right
+
+
+class IMDbItem(Base):
+    __tablename__ = 'imdb_items'
+    ID = Column(Integer, primary_key=True, autoincrement=True)
+    IMDbID = Column(String(20), nullable=False, unique=True)
+    Title = Column(String(1000))
+    Year = Column(Integer)
+    Rating = Column(Float)
+    Votes = Column(Integer)
+    PlotOutline = Column(Text)
+    ReleaseDate = Column(String(100))
+    ImageURL = Column(String(1000))
+    CachedAt = Column(BigInteger, nullable=False)  # epoch seconds
+    LastAccessedAt = Column(BigInteger, nullable=False, index=True)  # epoch seconds
+
+    @db.none_as_null
+    def __init__(self, imdb_id: str = None, title: str = None, year: int = None, rating: float = None,
+                 votes: int = None, plot_outline: str = None, release_date: str = None, image_url: str = None,
+                 **kwargs):
+        self.IMDbID = imdb_id or kwargs.get('IMDbID')
+        self.Title = title or kwargs.get('Title')
+        self.Year = year or kwargs.get('Year')
+        self.Rating = rating or kwargs.get('Rating')
+        self.Votes = votes or kwargs.get('Votes')
+        self.PlotOutline = plot_outline or kwargs.get('PlotOutline')
+        self.ReleaseDate = release_date or kwargs.get('ReleaseDate')
+        self.ImageURL = image_url or kwargs.get('ImageURL')
+        self.CachedAt = int(time.time())
+        self.LastAccessedAt = self.CachedAt
+
+
+class IMDbSearch(Base):
+    __tablename__ = 'imdb_searches'
+    SearchKey = Column(String(1100), primary_key=True)  # normalised title/year
+    IMDbID = Column(String(20))  # null when the search had no results
+    CachedAt = Column(BigInteger, nullable=False)  # epoch seconds
+
+    @db.none_as_null
+    def __init__(self, search_key: str = None, imdb_id: str = None, **kwargs):
+        self.SearchKey = search_key or kwargs.get('SearchKey')
+        self.IMDbID = imdb_id or kwargs.get('IMDbID')
+        self.CachedAt = int(time.time())
+
+
+def make_search_key(title: str, year: int = None) -> str:
+    return f"{title.strip().lower()}|{year or ''}"
+
+
+class IMDbCacheDatabase(db.SQLAlchemyDatabase):
+    def __init__(self,
+                 sqlite_file: str,
+                 ttl_hours: int = 168,
+                 max_entries: int = 10000,
+                 profile: db.SQLiteProfile = None):
+        super().__init__(sqlite_file=sqlite_file, profile=profile)
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries
+        IMDbItem.__table__.create(bind=self.engine, checkfirst=True)
+        IMDbSearch.__table__.create(bind=self.engine, checkfirst=True)
+
+    def _is_fresh(self, cached_at: int) -> bool:
+        return time.time() - cached_at < self.ttl_seconds
+
+    def get_item(self, imdb_id: str) -> Optional[IMDbItem]:
+        """
+        Get a cached IMDb item that has not expired, marking it as recently used
+        (at most once per ACCESS_TIME_RESOLUTION_SECONDS, so hits are read-only)
+
+        :param imdb_id:
+        :return:
+        """
+        item = self.session.query(IMDbItem).filter(IMDbItem.IMDbID == imdb_id).first()
+        if not item or not self._is_fresh(cached_at=item.CachedAt):
+            return None
+        now = int(time.time())
+        if now - item.LastAccessedAt >= ACCESS_TIME_RESOLUTION_SECONDS:
+            item.LastAccessedAt = now
+            self.commit()
+        return item
+
+    def get_search(self, title: str, year: int = None) -> Optional[IMDbSearch]:
+        """
+        Get a cached title/year search that has not expired
+
+        :param title:
+        :param year:
+        :return:
+        """
+        search = self.session.query(IMDbSearch) \
+            .filter(IMDbSearch.SearchKey == make_search_key(title=title, year=year)).first()
+        if not search or not self._is_fresh(cached_at=search.CachedAt):
+            return None
+        return search
+
+    def store_item(self, imdb_id: str, **kwargs):
+        """
+        Add or replace a cached IMDb item
+
+        :param imdb_id:
+        :param kwargs: IMDbItem fields
+        :return:
+        """
+        self.session.query(IMDbItem).filter(IMDbItem.IMDbID == imdb_id).delete(synchronize_session=False)
+        item = IMDbItem(imdb_id=imdb_id, **kwargs)
+        self.session.add(item)
+        self.commit()
+        self.evict()
+
+    def store_search(self, title: str, imdb_id: Optional[str], year: int = None):
+        """
+        Add or replace a cached title/year search
+
+        :param title:
+        :param imdb_id: None if nothing was found
+        :param year:
+        :return:
+        """
+        self.session.merge(IMDbSearch(search_key=make_search_key(title=title, year=year), imdb_id=imdb_id))
+        self.commit()
+
+    def evict(self):
+        """
+        Drop the least recently used items beyond max_entries, and any expired searches
+
+        :return:
+        """
+        overflow = self.session.query(func.count(IMDbItem.ID)).scalar() - self.max_entries
+        if overflow > 0:
+            stale_ids = self.session.query(IMDbItem.ID).order_by(IMDbItem.LastAccessedAt).limit(overflow)
+            self.session.query(IMDbItem).filter(IMDbItem.ID.in_(stale_ids.subquery().select())) \
+                .delete(synchronize_session=False)
+        self.session.query(IMDbSearch).filter(IMDbSearch.CachedAt < int(time.time()) - self.ttl_seconds) \
+            .delete(synchronize_session=False)
+        self.commit()
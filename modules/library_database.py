@@ -1,6 +1,10 @@
-from typing import List
+import random
+import time
+from typing import List, NamedTuple, Optional, Tuple
 
-from sqlalchemy import VARCHAR, Column, Integer, String, BigInteger, Boolean, func
+from sqlalchemy import VARCHAR, Column, Integer, String, BigInteger, Boolean, Float, Index, bindparam, func, \
+    or_, select, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 
 import databases.base as db
@@ -8,12 +12,30 @@ import databases.base as db
 Base = declarative_base()
 
 
+class ContentRecord(NamedTuple):
+    """
+    Compact content row used through the whole library sync, no ORM object is built for it
+    """
+    title: str
+    year: Optional[int]
+    rating_key: int
+    library_section_id: int
+    media_type: str
+    external_ids: Tuple[str, ...]  # i.e. ('imdb://tt0111161', 'tmdb://278')
+    updated_at: Optional[int] = None  # epoch seconds on Plex, falls back to when the item was added
+
+
 class ExternalIDs(Base):
     __tablename__ = 'external_ids'
     ID = Column(Integer, primary_key=True, autoincrement=True)
     ContentID = Column(Integer, nullable=False)
     ExternalID = Column(VARCHAR(500), nullable=False)
 
+    __table_args__ = (
+        Index('ix_external_ids_content_external_id', 'ContentID', 'ExternalID', unique=True),
+        Index('ix_external_ids_external_id', 'ExternalID'),  # GUID -> content lookups
+    )
+
     @db.none_as_null
     def __init__(self, content_id: int = None, external_id: str = None, **kwargs):
         self.ContentID = content_id or kwargs.get('ContentID')
@@ -29,6 +51,15 @@ class Content(Base):
     LibraryID = Column(Integer, nullable=False)
     MediaType = Column(String(100), nullable=False)
     OnPlex = Column(Boolean)
+    IMDbRating = Column(Float)
+    IMDbVotes = Column(Integer)
+    RatingCheckedAt = Column(BigInteger)  # epoch seconds, set even when no rating was found
+
+    __table_args__ = (
+        Index('ix_content_rating_key', 'RatingKey', unique=True),  # conflict target for bulk upserts
+        Index('ix_content_library_rating', 'LibraryID', 'IMDbRating'),
+        Index('ix_content_media_type_on_plex', 'MediaType', 'OnPlex'),
+    )
 
     @db.none_as_null
     def __init__(self, title: str = None, year: int = None, rating_key: int = None, library_section_id: int = None,
@@ -46,6 +77,12 @@ class Libraries(Base):
     ID = Column(Integer, primary_key=True, autoincrement=True)
     PlexID = Column(Integer, nullable=False)
     Name = Column(String(500))
+    LastUpdatedAt = Column(BigInteger)  # newest updatedAt/addedAt (epoch seconds) seen during a sync
+    LastFullScanAt = Column(BigInteger)  # epoch seconds
+
+    __table_args__ = (
+        Index('ix_libraries_plex_id', 'PlexID', unique=True),
+    )
 
     @db.none_as_null
     def __init__(self, name: str = None, plex_id: int = None, **kwargs):
@@ -53,13 +90,85 @@ class Libraries(Base):
         self.PlexID = plex_id or kwargs.get('PlexID')
 
 
+class WatchHistory(Base):
+    __tablename__ = 'watch_history'
+    ID = Column(Integer, primary_key=True, autoincrement=True)
+    UserID = Column(Integer, nullable=False)  # Tautulli/Plex user ID
+    RatingKey = Column(BigInteger, nullable=False)
+    LastWatched = Column(BigInteger, nullable=False)  # epoch seconds
+
+    __table_args__ = (
+        Index('ix_watch_history_user_rating_key', 'UserID', 'RatingKey', unique=True),
+        Index('ix_watch_history_user_last_watched', 'UserID', 'LastWatched'),
+    )
+
+
+class SyncContentStaging(Base):
+    """
+    Items fetched by a library sync in progress, merged into content when the sync finishes
+    """
+    __tablename__ = 'sync_content_staging'
+    RatingKey = Column(BigInteger, primary_key=True, autoincrement=False)
+    Title = Column(String(1000), nullable=False)
+    Year = Column(Integer)
+    LibraryID = Column(Integer, nullable=False)
+    MediaType = Column(String(100), nullable=False)
+
+
+class SyncExternalIDStaging(Base):
+    __tablename__ = 'sync_external_ids_staging'
+    ID = Column(Integer, primary_key=True, autoincrement=True)
+    RatingKey = Column(BigInteger, nullable=False, index=True)
+    ExternalID = Column(VARCHAR(500), nullable=False)
+
+
+def _migration_add_sync_and_rating_columns(database: db.SQLAlchemyDatabase):
+    for column in [Content.__table__.c.IMDbRating, Content.__table__.c.IMDbVotes,
+                   Content.__table__.c.RatingCheckedAt]:
+        database.add_column_if_missing(table=Content.__table__, column=column)
+    for column in [Libraries.__table__.c.LastUpdatedAt, Libraries.__table__.c.LastFullScanAt]:
+        database.add_column_if_missing(table=Libraries.__table__, column=column)
+
+
+def _migration_add_indexes(database: db.SQLAlchemyDatabase):
+    with database.engine.begin() as connection:
+        # Drop duplicates that would break the new unique indexes, keeping the oldest row
+        connection.exec_driver_sql('DELETE FROM content WHERE RatingKey IS NOT NULL AND ID NOT IN '
+                                   '(SELECT MIN(ID) FROM content GROUP BY RatingKey)')
+        connection.exec_driver_sql('DELETE FROM external_ids WHERE ContentID NOT IN (SELECT ID FROM content) '
+                                   'OR ID NOT IN (SELECT MIN(ID) FROM external_ids GROUP BY ContentID, ExternalID)')
+        connection.exec_driver_sql('DELETE FROM libraries WHERE ID NOT IN '
+                                   '(SELECT MIN(ID) FROM libraries GROUP BY PlexID)')
+    for table in [Content.__table__, ExternalIDs.__table__, Libraries.__table__, WatchHistory.__table__]:
+        for index in table.indexes:
+            index.create(bind=database.engine, checkfirst=True)
+
+
+def _migration_add_external_id_lookup_index(database: db.SQLAlchemyDatabase):
+    for index in ExternalIDs.__table__.indexes:
+        index.create(bind=database.engine, checkfirst=True)
+
+
+# Append only, the position of each migration is its schema version
+MIGRATIONS = [
+    _migration_add_sync_and_rating_columns,
+    _migration_add_indexes,
+    _migration_add_external_id_lookup_index,
+]
+
+
 class PlexContentDatabase(db.SQLAlchemyDatabase):
     def __init__(self,
-                 sqlite_file: str):
-        super().__init__(sqlite_file=sqlite_file)
+                 sqlite_file: str,
+                 profile: db.SQLiteProfile = None):
+        super().__init__(sqlite_file=sqlite_file, profile=profile)
         Content.__table__.create(bind=self.engine, checkfirst=True)
         ExternalIDs.__table__.create(bind=self.engine, checkfirst=True)
         Libraries.__table__.create(bind=self.engine, checkfirst=True)
+        WatchHistory.__table__.create(bind=self.engine, checkfirst=True)
+        SyncContentStaging.__table__.create(bind=self.engine, checkfirst=True)
+        SyncExternalIDStaging.__table__.create(bind=self.engine, checkfirst=True)
+        self.migrate(migrations=MIGRATIONS)
 
     def add_library(self, name: str, plex_id: int):
         """
@@ -72,26 +181,103 @@ class PlexContentDatabase(db.SQLAlchemyDatabase):
         library = self.create_entry_if_does_not_exist(table_schema=Libraries, fields_to_check=["PlexID"], Name=name,
                                                       PlexID=plex_id)
 
-    def add_content(self, title: str, year: int, rating_key: int, library_section_id: int, media_type: str,
-                    external_ids: List[str] = None):
+    def get_library(self, plex_id: int):
         """
-        Add a new content item
+        Get a library by its Plex section ID
 
-        :param external_ids:
-        :param title:
-        :param year:
-        :param rating_key:
-        :param library_section_id:
-        :param media_type:
+        :param plex_id:
         :return:
         """
-        content = self.create_entry_if_does_not_exist(table_schema=Content, fields_to_check=["RatingKey"],
-                                                      Title=title, Year=year, RatingKey=rating_key,
-                                                      LibraryID=library_section_id,
-                                                      MediaType=media_type, OnPlex=True)
-        if external_ids:
+        return self.session.query(Libraries).filter(Libraries.PlexID == int(plex_id)).first()
+
+    def set_library_sync_status(self, plex_id: int, last_updated_at: int = None, full_scan_at: int = None):
+        """
+        Store the sync watermark and (optionally) the time of the last full scan for a library
+
+        :param plex_id:
+        :param last_updated_at:
+        :param full_scan_at:
+        :return:
+        """
+        library = self.get_library(plex_id=plex_id)
+        if not library:
+            return
+        if last_updated_at is not None:
+            library.LastUpdatedAt = last_updated_at
+        if full_scan_at is not None:
+            library.LastFullScanAt = full_scan_at
+        self.commit()
+
+    def begin_staged_sync(self):
+        """
+        Clear out the staging tables (i.e. left over from an interrupted sync) before a library sync
+
+        :return:
+        """
+        with self.transaction():
+            self.session.query(SyncExternalIDStaging).delete(synchronize_session=False)
+            self.session.query(SyncContentStaging).delete(synchronize_session=False)
+
+    def stage_content(self, contents: List[ContentRecord]) -> int:
+        """
+        Write a batch of synced items to the staging tables, readers of content don't see them yet
+
+        :param contents:
+        :return: number of content items staged
+        """
+        if not contents:
+            return 0
+        with self.transaction():
+            statement = sqlite_insert(SyncContentStaging.__table__)
+            statement = statement.on_conflict_do_update(
+                index_elements=[SyncContentStaging.RatingKey],
+                set_={column: statement.excluded[column] for column in ['Title', 'Year', 'LibraryID', 'MediaType']})
+            self.session.execute(statement, [{'RatingKey': content.rating_key,
+                                              'Title': content.title,
+                                              'Year': content.year,
+                                              'LibraryID': content.library_section_id,
+                                              'MediaType': content.media_type} for content in contents])
+            rating_keys = [content.rating_key for content in contents]
+            self.session.query(SyncExternalIDStaging).filter(SyncExternalIDStaging.RatingKey.in_(rating_keys)) \
+                .delete(synchronize_session=False)
+            external_id_rows = [{'RatingKey': content.rating_key, 'ExternalID': external_id}
+                                for content in contents
+                                for external_id in dict.fromkeys(content.external_ids)]
+            if external_id_rows:
+                self.session.execute(SyncExternalIDStaging.__table__.insert(), external_id_rows)
+        return len(contents)
+
+    def apply_staged_sync(self, removed_rating_keys: List[int] = None,
+                          library_sync_statuses: List[Tuple[int, int, Optional[int]]] = None):
+        """
+        Merge the staged sync into content in one short transaction, so readers only ever see
+        the library as it was before the sync or as it is after it
+
+        :param removed_rating_keys: items to flag as no longer on Plex
+        :param library_sync_statuses: (Plex section ID, last updated at, full scan at or None) for each synced library
+        :return:
+        """
+        with self.transaction():
+            connection = self.session.connection()
+            # WHERE true: SQLite needs it to tell the upsert's ON CONFLICT from a join constraint
+            connection.exec_driver_sql(
+                'INSERT INTO content (Title, Year, RatingKey, LibraryID, MediaType, OnPlex) '
+                'SELECT Title, Year, RatingKey, LibraryID, MediaType, 1 FROM sync_content_staging WHERE true '
+                'ON CONFLICT (RatingKey) DO UPDATE SET Title = excluded.Title, Year = excluded.Year, '
+                'LibraryID = excluded.LibraryID, MediaType = excluded.MediaType, OnPlex = excluded.OnPlex')
             # will always reset the external ids during refresh
-            self.set_external_ids_for_content(content=content, external_ids=external_ids)
+            connection.exec_driver_sql(
+                'DELETE FROM external_ids WHERE ContentID IN '
+                '(SELECT content.ID FROM content JOIN sync_content_staging USING (RatingKey))')
+            connection.exec_driver_sql(
+                'INSERT OR IGNORE INTO external_ids (ContentID, ExternalID) '
+                'SELECT content.ID, staged.ExternalID FROM sync_external_ids_staging AS staged '
+                'JOIN content ON content.RatingKey = staged.RatingKey')
+            self.mark_content_not_on_plex(rating_keys=removed_rating_keys)
+            for plex_id, last_updated_at, full_scan_at in library_sync_statuses or []:
+                self.set_library_sync_status(plex_id=plex_id, last_updated_at=last_updated_at,
+                                             full_scan_at=full_scan_at)
+            self.begin_staged_sync()  # empty the staging tables, part of the same transaction
 
     def get_content(self, content_id: int = None, title: str = None, year: int = None, library_section_id: int = None,
                     media_type: str = None):
@@ -126,6 +312,24 @@ class PlexContentDatabase(db.SQLAlchemyDatabase):
         content.OnPlex = plex_status
         self.commit()
 
+    def replace_rating_key(self, content_id: int, rating_key: int):
+        """
+        Point a content item at the rating key Plex now uses for it
+
+        :param content_id:
+        :param rating_key:
+        :return:
+        """
+        content = self.session.query(Content).filter(Content.ID == content_id).first()
+        if not content:
+            return
+        if self.session.query(Content.ID).filter(Content.RatingKey == rating_key, Content.ID != content_id).first():
+            content.OnPlex = False  # a sync already added the new key, this row is the stale copy
+        else:
+            content.RatingKey = rating_key
+            content.OnPlex = True
+        self.commit()
+
     def delete_content(self, content: Content = None, content_id: int = None):
         """
         Delete a content item
@@ -135,11 +339,35 @@ class PlexContentDatabase(db.SQLAlchemyDatabase):
         :return:
         """
         content_id = content_id or content.ID
-        self.delete_external_ids_for_content(content_id=content_id)
-        if content:
-            content.delete()
-        else:
-            self.session.query(Content).filter(Content.ID == content_id).delete()
+        with self.transaction():
+            self.delete_external_ids_for_content(content_id=content_id)
+            if content:
+                content.delete()
+            else:
+                self.session.query(Content).filter(Content.ID == content_id).delete()
+
+    def get_rating_keys_for_library(self, library_section_id: int) -> set:
+        """
+        Get the rating keys of all content in a library section that is still on Plex
+
+        :param library_section_id:
+        :return:
+        """
+        rows = self.session.query(Content.RatingKey) \
+            .filter(Content.LibraryID == int(library_section_id), Content.OnPlex == True).all()  # noqa: E712
+        return {row[0] for row in rows}
+
+    def mark_content_not_on_plex(self, rating_keys: List[int]):
+        """
+        Flag content items as no longer on Plex
+
+        :param rating_keys:
+        :return:
+        """
+        if not rating_keys:
+            return
+        self.session.query(Content).filter(Content.RatingKey.in_(list(rating_keys))) \
+            .update({Content.OnPlex: False}, synchronize_session=False)
         self.commit()
 
     def get_external_ids_for_content(self, content: Content = None, content_id: int = None):
@@ -153,6 +381,40 @@ class PlexContentDatabase(db.SQLAlchemyDatabase):
         content_id = content_id or content.ID
         return self.get_all_by_filters(ExternalIDs, ContentID=content_id)
 
+    def get_content_ids_by_external_ids(self, external_ids: List[str],
+                                        library_section_ids: List[int] = None) -> List[int]:
+        """
+        Match a large batch of external IDs against the library in one join
+
+        :param external_ids: Plex GUIDs (i.e. 'imdb://tt0111161', 'tmdb://278')
+        :param library_section_ids: only look in these library sections
+        :return: IDs of every content item on Plex with at least one of the external IDs
+        """
+        if not external_ids:
+            return []
+        connection = self.session.connection()
+        # Temp tables live on this connection only, and don't hit the 999-variable limit of an IN list
+        connection.exec_driver_sql('CREATE TEMP TABLE IF NOT EXISTS wanted_external_ids '
+                                   '(ExternalID VARCHAR(500) PRIMARY KEY)')
+        try:
+            connection.exec_driver_sql('DELETE FROM wanted_external_ids')
+            connection.execute(text('INSERT OR IGNORE INTO wanted_external_ids (ExternalID) VALUES (:external_id)'),
+                               [{'external_id': external_id} for external_id in external_ids])
+            query = 'SELECT DISTINCT content.ID FROM wanted_external_ids ' \
+                    'JOIN external_ids ON external_ids.ExternalID = wanted_external_ids.ExternalID ' \
+                    'JOIN content ON content.ID = external_ids.ContentID ' \
+                    'WHERE content.OnPlex = 1'
+            params = {}
+            statement = text(query)
+            if library_section_ids:
+                statement = text(f'{query} AND content.LibraryID IN :library_ids') \
+                    .bindparams(bindparam('library_ids', expanding=True))
+                params['library_ids'] = [int(i) for i in library_section_ids]
+            return [row[0] for row in connection.execute(statement, params)]
+        finally:
+            connection.exec_driver_sql('DROP TABLE IF EXISTS wanted_external_ids')
+            self.commit()
+
     def set_external_ids_for_content(self, content: Content = None, content_id: int = None,
                                      external_ids: List[str] = None):
         """
@@ -164,11 +426,11 @@ class PlexContentDatabase(db.SQLAlchemyDatabase):
         :return:
         """
         content_id = content_id or content.ID
-        self.delete_external_ids_for_content(content_id=content_id)
-        for external_id in external_ids:
-            external_ids_object = ExternalIDs(content_id=content_id, external_id=external_id)
-            self.session.add(external_ids_object)
-        self.commit()
+        with self.transaction():
+            self.delete_external_ids_for_content(content_id=content_id)
+            for external_id in external_ids:
+                external_ids_object = ExternalIDs(content_id=content_id, external_id=external_id)
+                self.session.add(external_ids_object)
 
     def delete_external_ids_for_content(self, content: Content = None, content_id: int = None):
         """
@@ -183,6 +445,152 @@ class PlexContentDatabase(db.SQLAlchemyDatabase):
             .filter(ExternalIDs.ContentID == content_id).delete()
         self.commit()
 
+    def get_contents_by_ids(self, content_ids: List[int], on_plex_only: bool = False) -> List[Content]:
+        """
+        Get content items by their IDs
+
+        :param content_ids:
+        :param on_plex_only: leave out items no longer on Plex
+        :return:
+        """
+        if not content_ids:
+            return []
+        query = self.session.query(Content).filter(Content.ID.in_(content_ids))
+        if on_plex_only:
+            query = query.filter(Content.OnPlex == True)  # noqa: E712
+        return query.all()
+
+    def get_sampling_rows(self):
+        """
+        Get the ID, media type and library of every content item that is on Plex
+
+        :return:
+        """
+        return self.session.query(Content.ID, Content.MediaType, Content.LibraryID) \
+            .filter(Content.OnPlex == True).all()  # noqa: E712
+
+    def get_contents_needing_rating(self, count: int = 50,
+                                    max_age_days: int = 30) -> List[Tuple[int, str, int, Optional[str]]]:
+        """
+        Get content items whose IMDb rating has never been looked up, or was looked up too long ago.
+        Never-checked items come first, in random order, so items whose lookups keep failing don't hold up the rest.
+
+        :param count:
+        :param max_age_days:
+        :return: (content ID, title, year, IMDb GUID or None) tuples
+        """
+        stale_before = int(time.time()) - max_age_days * 86400
+        return self.session.query(Content.ID, Content.Title, Content.Year, ExternalIDs.ExternalID) \
+            .outerjoin(ExternalIDs, (ExternalIDs.ContentID == Content.ID) & ExternalIDs.ExternalID.like('imdb://%')) \
+            .filter(Content.OnPlex == True,  # noqa: E712
+                    or_(Content.RatingCheckedAt == None, Content.RatingCheckedAt < stale_before)) \
+            .order_by(Content.RatingCheckedAt, func.random()) \
+            .limit(count).all()
+
+    def get_contents_to_rate(self, content_ids: List[int]) -> List[Tuple[int, str, int, Optional[str]]]:
+        """
+        Get what's needed to look up the IMDb ratings of specific content items
+
+        :param content_ids:
+        :return: (content ID, title, year, IMDb GUID or None) tuples
+        """
+        if not content_ids:
+            return []
+        return self.session.query(Content.ID, Content.Title, Content.Year, ExternalIDs.ExternalID) \
+            .outerjoin(ExternalIDs, (ExternalIDs.ContentID == Content.ID) & ExternalIDs.ExternalID.like('imdb://%')) \
+            .filter(Content.ID.in_(content_ids)).all()
+
+    def set_content_ratings(self, ratings: List[Tuple[int, float, int]]):
+        """
+        Store IMDb ratings for a batch of content items
+
+        :param ratings: (content ID, rating, votes) tuples, rating and votes may be None
+        :return:
+        """
+        if not ratings:
+            return
+        checked_at = int(time.time())
+        statement = update(Content.__table__) \
+            .where(Content.__table__.c.ID == bindparam('content_id')) \
+            .values(IMDbRating=bindparam('rating'), IMDbVotes=bindparam('votes'), RatingCheckedAt=checked_at)
+        self.session.execute(statement, [{'content_id': content_id, 'rating': rating, 'votes': votes}
+                                         for content_id, rating, votes in ratings])
+        self.commit()
+
+    def get_random_content_with_rating(self, library_section_ids: List[int], rating: float,
+                                       above: bool = True) -> Content:
+        """
+        Get a random content item rated above/below a given IMDb rating
+
+        :param library_section_ids:
+        :param rating:
+        :param above:
+        :return:
+        """
+        rating_filter = Content.IMDbRating >= rating if above else Content.IMDbRating <= rating
+        matching = self.session.query(Content) \
+            .filter(Content.LibraryID.in_([int(i) for i in library_section_ids]), rating_filter,
+                    Content.OnPlex == True)  # noqa: E712
+        # Count over the (LibraryID, IMDbRating) index, then skip to one random row, no IDs loaded into Python
+        count = matching.with_entities(func.count(Content.ID)).scalar()
+        if not count:
+            return None
+        return matching.offset(random.randrange(count)).limit(1).first()
+
+    def get_unrated_content_ids(self, library_section_ids: List[int]) -> List[int]:
+        """
+        Get the IDs of content items whose IMDb rating has not been looked up yet
+
+        :param library_section_ids:
+        :return:
+        """
+        return [content_id for content_id, in self.session.query(Content.ID)
+                .filter(Content.LibraryID.in_([int(i) for i in library_section_ids]), Content.RatingCheckedAt == None,
+                        Content.OnPlex == True).all()]  # noqa: E711, E712
+
+    def get_last_watched_at(self, user_id: int) -> int:
+        """
+        Get when the user's most recent play in the local watch history happened
+
+        :param user_id:
+        :return: epoch seconds, 0 if nothing is stored
+        """
+        return self.session.query(func.max(WatchHistory.LastWatched)) \
+            .filter(WatchHistory.UserID == user_id).scalar() or 0
+
+    def add_watch_history(self, user_id: int, plays: List[Tuple[int, int]]):
+        """
+        Record plays for a user, keeping the latest play time for each rating key
+
+        :param user_id:
+        :param plays: (rating key, played at epoch seconds) pairs
+        :return:
+        """
+        if not plays:
+            return
+        statement = sqlite_insert(WatchHistory.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=[WatchHistory.UserID, WatchHistory.RatingKey],
+            set_={'LastWatched': func.max(WatchHistory.__table__.c.LastWatched, statement.excluded.LastWatched)})
+        self.session.execute(statement, [{'UserID': user_id, 'RatingKey': rating_key, 'LastWatched': played_at}
+                                         for rating_key, played_at in plays])
+        self.commit()
+
+    def get_random_unwatched_content(self, user_id: int, library_section_ids: List[int]) -> Content:
+        """
+        Get a random content item the user has never played
+
+        :param user_id:
+        :param library_section_ids:
+        :return:
+        """
+        return self.session.query(Content) \
+            .outerjoin(WatchHistory, (WatchHistory.RatingKey == Content.RatingKey) & (WatchHistory.UserID == user_id)) \
+            .filter(WatchHistory.RatingKey == None,  # noqa: E711
+                    Content.LibraryID.in_([int(i) for i in library_section_ids]),
+                    Content.OnPlex == True) \
+            .order_by(func.random()).first()  # noqa: E712
+
     def get_random_contents_for_library(self, library_section_id: int, count: int = 1):
         """
         Get random content for a library section
@@ -192,7 +600,7 @@ class PlexContentDatabase(db.SQLAlchemyDatabase):
         :return:
         """
         return self.session.query(Content). \
-            filter_by(LibraryID=library_section_id).order_by(func.random()).limit(count).all()
+            filter_by(LibraryID=library_section_id, OnPlex=True).order_by(func.random()).limit(count).all()
 
     def get_random_contents_of_type(self, media_type: str, count: int = 1):
         """
@@ -202,7 +610,8 @@ class PlexContentDatabase(db.SQLAlchemyDatabase):
         :param count:
         :return:
         """
-        return self.session.query(Content).filter_by(MediaType=media_type).order_by(func.random()).limit(count).all()
+        return self.session.query(Content).filter_by(MediaType=media_type, OnPlex=True) \
+            .order_by(func.random()).limit(count).all()
 
     def purge(self):
         """
@@ -210,6 +619,8 @@ class PlexContentDatabase(db.SQLAlchemyDatabase):
 
         :return:
         """
-        for content in self.session.query(Content).filter(Content.OnPlex is False).all():
-            content.delete()
+        removed_ids = select(Content.ID).where(Content.OnPlex == False)  # noqa: E712
+        self.session.query(ExternalIDs).filter(ExternalIDs.ContentID.in_(removed_ids)) \
+            .delete(synchronize_session=False)
+        self.session.query(Content).filter(Content.OnPlex == False).delete(synchronize_session=False)  # noqa: E712
         self.commit()
@@ -1,6 +1,10 @@
 import logging
 
 
+def debug(message):
+    logging.debug(msg=message)
+
+
 def info(message):
     logging.info(msg=message)
 
@@ -7,66 +7,81 @@ from modules.plex_connector import PlexConnector
 from modules.trakt_connector import TraktConnector
 
 
-def _rating_is_correct(imdb_item, rating: float, above: bool = True):
-    if not imdb_item.rating:
+def _rating_is_correct(imdb_rating: float, rating: float, above: bool = True):
+    if not imdb_rating:
         return False
-    elif above and imdb_item.rating < rating:  # want above and temp_choice is not above rating
+    elif above and imdb_rating < rating:  # want above and temp_choice is not above rating
         return False
-    elif not above and imdb_item.rating > rating:  # want below and temp_choice is not below rating
+    elif not above and imdb_rating > rating:  # want below and temp_choice is not below rating
         return False
     return True
 
 
 def pick_with_rating(plex_connector: PlexConnector, media_type: str, rating: float, above: bool = True,
-                     attempts: int = 10):
-    attempt_counter = 0
-    while attempt_counter < attempts:
-        choice = plex_connector.get_random_media_item(media_type=media_type)
-        imdb_item = imdb.get_imdb_item(choice.Title, choice.Year)
-        if _rating_is_correct(imdb_item=imdb_item, rating=rating, above=above):
-            return choice
-        attempt_counter += 1
-    return "Too many attempts"
+                     batch_size: int = 10):
+    """
+    Pick from content already rated on IMDb with one indexed query
+    While ratings are still being filled in, fall back to rating unrated items live, a shuffled batch at a time,
+    until one matches or none are left (rated items already missed the query)
+    Live ratings are stored, so each item is only looked up once
+    :return: Content object
+    """
+    section_ids = plex_connector.get_section_ids_for_media_type(media_type)
+    choice = plex_connector.database.get_random_content_with_rating(library_section_ids=section_ids,
+                                                                    rating=rating, above=above)
+    if choice:
+        return choice
+    unrated_ids = plex_connector.database.get_unrated_content_ids(library_section_ids=section_ids)
+    if not unrated_ids:
+        return "No matches"
 
+    random.shuffle(unrated_ids)
+    for batch_start in range(0, len(unrated_ids), batch_size):
+        ratings = plex_connector.rate_contents(content_ids=unrated_ids[batch_start:batch_start + batch_size])
+        matching_ids = [content_id for content_id, imdb_rating, _ in ratings
+                        if _rating_is_correct(imdb_rating=imdb_rating, rating=rating, above=above)]
+        if matching_ids:
+            return plex_connector.database.get_contents_by_ids(content_ids=[random.choice(matching_ids)])[0]
+    return "No matches"
 
-def pick_unwatched(plex_connector: PlexConnector, username: str, media_type: str, attempts: int = 10):
+
+def pick_unwatched(plex_connector: PlexConnector, username: str, media_type: str):
     """
-    Keep picking until something is unwatched
+    Pick straight from the pool of items the user has never played
     :param media_type:
     :param username:
     :param plex_connector:
-    :return: SmallMediaItem object
+    :return: Content object
     """
-    history = plex_connector.get_user_history(username=username,
-                                              section_ids=plex_connector.get_section_ids_for_media_type(media_type))
-    if history == "Error":
+    user_id = plex_connector.sync_user_history(username=username)
+    if user_id is None:
         return False
-
-    attempt_counter = 0
-    while attempt_counter < attempts:  # give up after ten failures
-        choice = plex_connector.get_random_media_item(media_type=media_type)
-        if choice.Title not in history:
-            return choice
-        attempt_counter += 1
-    return "Too many attempts"
+    choice = plex_connector.database.get_random_unwatched_content(
+        user_id=user_id, library_section_ids=plex_connector.get_section_ids_for_media_type(media_type))
+    return choice or "No matches"
 
 
 def pick_from_trakt_list(trakt_connector: TraktConnector, trakt_list_name: str, plex_connector: PlexConnector,
-                         attempts: int = 5):
-    trakt_list = trakt_connector.get_list_items(list_name=trakt_list_name)
-    attempt_counter = 0
-    while attempt_counter < attempts:  # give up after five failures
-        trakt_choice = random.choice(trakt_list)
-        info(f"Choice from Trakt: {trakt_choice.title}, {trakt_choice.year}")
-        external_ids = imdb.build_ids_dict(trakt_choice.ids['ids'])
-        plex_equivalent = plex_connector.is_on_plex(title=trakt_choice.title, year=trakt_choice.year,
-                                                    external_ids=external_ids, match_rating_keys=False)
-        if plex_equivalent:
-            info(f"Match from Plex: {plex_equivalent.title}, {plex_equivalent.year}")
-            return plex_equivalent
-        info(f"Couldn't find {trakt_choice.title} on Plex. Trying a different item...")
-        attempt_counter += 1
-    return "Too many attempts"
+                         media_type: str = None):
+    """
+    Pick uniformly from every list item that is on Plex
+    :return: Content object
+    """
+    section_ids = plex_connector.get_section_ids_for_media_type(media_type) if media_type else None
+    trakt_list = trakt_connector.get_list_snapshot(list_name=trakt_list_name)
+    if not trakt_list:
+        return "No matches"
+
+    def get_list_external_ids():
+        return [guid for trakt_item in trakt_list.items for guid in imdb.build_guids(trakt_item.ids)]
+
+    # A new list version gets a new key, so changed lists are joined again
+    content_ids = plex_connector.get_list_matches(list_key=(trakt_list_name, trakt_list.updated_at, media_type),
+                                                  get_external_ids=get_list_external_ids, section_ids=section_ids)
+    info(f"Found {len(content_ids)} items from Trakt list {trakt_list_name} on Plex")
+    if not content_ids:
+        return "No matches"
+    return plex_connector.database.get_contents_by_ids(content_ids=[random.choice(content_ids)])[0]
 
 
 def pick_random(plex_connector: PlexConnector, media_type: str):
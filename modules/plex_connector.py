@@ -1,27 +1,36 @@
-from typing import List
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Generator, List, NamedTuple, Optional, Set, Tuple
 
-from plexapi.library import LibrarySection
+import requests
+from plexapi.exceptions import BadRequest, NotFound
+from plexapi.library import Library, LibrarySection
 from plexapi.media import Guid
 from plexapi.server import PlexServer
-from progress.bar import Bar
+from plexapi.utils import joinArgs
 
+import modules.imdb_connector as imdb
 import modules.tautulli_connector as tautulli
 from modules.analytics import GoogleAnalytics
-from modules.library_database import PlexContentDatabase, Content
+from modules.cache import LRUCache
+from modules.library_database import PlexContentDatabase, Content, ContentRecord
 from modules.logs import *
+from modules.sampling_index import SamplingIndex
 
 
 def get_possible_matching_items(library_section, title, year, external_ids: List[str] = None) -> List:
     matches = []
-    if external_ids:
-        if 'guid' not in library_section.ALLOWED_FILTERS:
-            library_section.ALLOWED_FILTERS += ('guid',)
-        for e_id in external_ids:
-            for item in library_section.search(guid=f"{e_id}"):
-                if item not in matches:
-                    matches.append(item)
-    else:
-        matches = library_section.search(title=title, year=[year])
+    for e_id in external_ids or []:
+        try:
+            item = library_section.getGuid(e_id)
+        except NotFound:
+            continue
+        if item not in matches:
+            matches.append(item)
+    if not matches:
+        matches = library_section.search(title=title, year=[year]) if year else library_section.search(title=title)
     return matches
 
 
@@ -75,6 +84,20 @@ def search(library_section: LibrarySection,
     return search_results
 
 
+def _content_record_from_element(element, library_section_id: int) -> ContentRecord:
+    attributes = element.attrib
+    year = attributes.get('year')
+    updated_at = attributes.get('updatedAt') or attributes.get('addedAt')
+    external_ids = tuple(guid.attrib['id'] for guid in element.iter('Guid') if guid.attrib.get('id'))
+    return ContentRecord(title=attributes.get('title'),
+                         year=int(year) if year else None,
+                         rating_key=int(attributes['ratingKey']),
+                         library_section_id=library_section_id,
+                         media_type=attributes.get('type'),
+                         external_ids=external_ids,
+                         updated_at=int(updated_at) if updated_at else None)
+
+
 class SmallMediaItem:
     def __init__(self, title, year, rating_key, library_section_id, media_type, external_ids: List[str] = None):
         self.title = title
@@ -84,26 +107,72 @@ class SmallMediaItem:
         self.type = media_type
         self.external_ids = external_ids
 
-    def add_to_database(self, database: PlexContentDatabase):
-        database.add_content(title=self.title, year=self.year, rating_key=self.rating_key,
-                             library_section_id=self.library_section_id, media_type=self.type,
-                             external_ids=self.external_ids)
+
+class _ScanCancelled(Exception):
+    pass
+
+
+def _put_write(writes: queue.Queue, stop: threading.Event, write: tuple):
+    """
+    Hand a write to the database writer, giving up if the writer has stopped (i.e. it failed)
+    """
+    while not stop.is_set():
+        try:
+            writes.put(write, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+    raise _ScanCancelled()
+
+
+def _drain(writes: queue.Queue):
+    while True:
+        try:
+            writes.get_nowait()
+        except queue.Empty:
+            return
+
+
+class _SectionScan(NamedTuple):
+    full_scan: bool
+    newest_timestamp: int
+    changed_rating_keys: Set[int]
+    on_plex_rating_keys: Set[int]
+    fetch_seconds: float
 
 
 class PlexConnector:
     def __init__(self, url: str, token: str, server_name: str, library_list: dict, tautulli_url: str, tautulli_key: str,
-                 analytics: GoogleAnalytics, database: PlexContentDatabase):
+                 analytics: GoogleAnalytics, database: PlexContentDatabase, sync_chunk_size: int = 500,
+                 full_rescan_interval_hours: int = 24, history_ttl_minutes: int = 10,
+                 session: requests.Session = None, scan_workers: int = 4, fetch_page_size: int = 1000):
         self.name = server_name
-        self.server = PlexServer(baseurl=url, token=token)
+        self.server = PlexServer(baseurl=url, token=token, session=session)
         self.analytics = analytics
         info("Connected to Plex.")
         self.library_config = library_list
         self.tautulli = tautulli.TautulliConnector(url=tautulli_url, api_key=tautulli_key,
-                                                   analytics=analytics)
+                                                   analytics=analytics, user_ttl_minutes=history_ttl_minutes,
+                                                   session=session)
         info("Connected to Tautulli.")
         self.database = database
+        self.sync_chunk_size = sync_chunk_size
+        self.full_rescan_interval_hours = full_rescan_interval_hours
+        self.scan_workers = max(1, scan_workers)
+        self.fetch_page_size = fetch_page_size
+        self._list_matches = LRUCache(max_size=100, ttl_seconds=3600)  # list key -> content IDs, reset by syncs
+        self._fresh_history_users = LRUCache(max_size=1000, ttl_seconds=history_ttl_minutes * 60)
+        self._history_locks = {}  # one per user ID, so users don't wait on each other's Tautulli pages
+        self._history_locks_lock = threading.Lock()
+        self._sync_listeners: List[Callable[[set], None]] = []
+        self._media_items = LRUCache(max_size=200, ttl_seconds=600)  # rating key -> PlexAPI item, reset by syncs
+        # One 'by_id' entry holding {section ID: LibrarySection}, reset by syncs
+        self._sections = LRUCache(max_size=1, ttl_seconds=300)
+        self._clients = LRUCache(max_size=1, ttl_seconds=60)
         info("Connected to database.")
         self.initialize_libraries()
+        self.sampling_index = SamplingIndex()
+        self.rebuild_sampling_index()
         self.owner_players = []
 
     def get_section_ids_for_media_type(self, media_type: str):
@@ -116,60 +185,345 @@ class PlexConnector:
         self.analytics.event(event_category="Error", event_action=function_name, random_uuid_if_needed=True)
 
     def initialize_libraries(self):
-        for name, numbers in self.library_config.items():
-            for number in numbers:
-                self.database.add_library(name=name, plex_id=number)
-                info(f"Added library {name} with number {number} to database.")
+        with self.database.transaction():
+            for name, numbers in self.library_config.items():
+                for number in numbers:
+                    self.database.add_library(name=name, plex_id=number)
+                    info(f"Added library {name} with number {number} to database.")
 
-    def get_random_media_item(self, library_id: int = None, media_type: str = None):
+    def rebuild_sampling_index(self):
+        self.sampling_index.rebuild(rows=self.database.get_sampling_rows())
+
+    def get_random_media_items(self, library_id: int = None, media_type: str = None, count: int = 1) -> List[Content]:
+        """
+        Get up to count distinct random content items
+
+        :param library_id: Plex library section ID
+        :param media_type: library group (i.e. 'movie', '4k', 'music') or Plex media type
+        :param count:
+        :return:
+        """
         if library_id:
-            return self.database.get_random_contents_for_library(library_section_id=library_id)[0]
+            library_ids = [library_id]
         else:
-            return self.database.get_random_contents_of_type(media_type=media_type)[0]
+            library_ids = self.get_section_ids_for_media_type(media_type=media_type)
+        content_ids = self.sampling_index.sample(media_type=media_type, library_ids=library_ids, count=count)
+        if content_ids:
+            contents = self.database.get_contents_by_ids(content_ids=content_ids, on_plex_only=True)
+            if len(contents) == len(content_ids):
+                return contents
+            # Some picks were removed by a sync the index hasn't caught up with yet
+        # Index not built yet (or behind), go to the database
+        if library_id:
+            return self.database.get_random_contents_for_library(library_section_id=library_id, count=count)
+        return self.database.get_random_contents_of_type(media_type=media_type, count=count)
+
+    def get_random_media_item(self, library_id: int = None, media_type: str = None):
+        items = self.get_random_media_items(library_id=library_id, media_type=media_type)
+        return items[0] if items else None
 
     def clean_libraries(self):
         self.database.purge()
 
-    def _populate_library(self, library_name: str):
-        if library_name not in self.library_config.keys():
-            return
-        for library_number in self.library_config[library_name]:
-            tautulli_data = self.tautulli.get_library(library_number=library_number)
-            if not tautulli_data:
-                self._error_and_analytics(f"Could not find library {library_number} on Tautulli", "_populate_library")
-                continue
-            bar = Bar('Populating library', max=tautulli_data.count)
-            library_section = self.server.library.sectionByID(library_number)
+    def _iter_section_elements(self, library_section: LibrarySection, params: dict = None) -> Generator:
+        """
+        Page through a section's listing as raw XML, one container page in memory at a time
+
+        :param library_section:
+        :param params: extra query parameters (i.e. filters)
+        :return: item elements
+        """
+        start = 0
+        while True:
+            page_params = dict(params or {})
+            page_params.update({'X-Plex-Container-Start': start, 'X-Plex-Container-Size': self.fetch_page_size})
+            # joinArgs leaves keys unencoded, like PlexAPI's own searches (i.e. 'updatedAt>>=')
+            data = self.server.query(f"/library/sections/{library_section.key}/all{joinArgs(page_params)}")
+            elements = [element for element in data if element.attrib.get('ratingKey')]
+            yield from elements
+            start += len(data)
+            if len(data) < self.fetch_page_size:
+                return
+
+    def _get_section_rating_keys(self, library_section: LibrarySection) -> set:
+        # Raw XML query, skips building a PlexAPI object for every item
+        return {int(element.attrib['ratingKey'])
+                for element in self._iter_section_elements(library_section=library_section)}
+
+    def _needs_full_rescan(self, library_number: int) -> bool:
+        library = self.database.get_library(plex_id=library_number)
+        if not library or library.LastUpdatedAt is None or library.LastFullScanAt is None:
+            return True
+        return time.time() - library.LastFullScanAt >= self.full_rescan_interval_hours * 3600
+
+    def _iter_section_items(self, library_section: LibrarySection, updated_since: int = None) -> Generator:
+        """
+        Stream a section's items page by page, so memory stays flat whatever the library size
+
+        :param library_section:
+        :param updated_since: epoch seconds, only items updated after this (all items if None)
+        :return: ContentRecord records
+        """
+        library_section_id = int(library_section.key)
+        params = {'includeGuids': 1}
+        if updated_since is not None:
+            elements = self._iter_section_elements(library_section=library_section,
+                                                   params={**params, 'updatedAt>>': updated_since})
+            try:
+                first_element = next(elements, None)
+            except (BadRequest, NotFound) as e:
+                info(f"Could not filter library {library_section.key} by updatedAt ({e}), falling back to a full scan")
+            else:
+                if first_element is not None:
+                    yield _content_record_from_element(element=first_element, library_section_id=library_section_id)
+                    for element in elements:
+                        yield _content_record_from_element(element=element, library_section_id=library_section_id)
+                return
+        for element in self._iter_section_elements(library_section=library_section, params=params):
+            yield _content_record_from_element(element=element, library_section_id=library_section_id)
+
+    def add_sync_listener(self, callback: Callable[[set], None]):
+        """
+        Register a callback to get the rating keys that were changed or removed by each library sync
+
+        :param callback:
+        :return:
+        """
+        self._sync_listeners.append(callback)
+
+    def _scan_section(self, library_number: int, full_scan: bool, previous_watermark: Optional[int],
+                      writes: queue.Queue, stop: threading.Event):
+        """
+        Fetch a section from Plex, handing chunks of rows to the database writer (producer, runs on a scan worker)
+
+        :param library_number: Plex library section ID
+        :param full_scan: fetch every item, not only those updated since previous_watermark
+        :param previous_watermark: newest item update seen by the last sync
+        :param writes: ("chunk", library number, rows) per chunk, then ("done", library number, _SectionScan or None)
+        :param stop: set by the writer when it gives up, the scan then stops too
+        :return:
+        """
+        result = None
+        try:
+            start_time = time.perf_counter()
+            library_section = self.get_library_section(section_id=library_number)
             if not library_section:
-                self._error_and_analytics(f"Could not find library {library_number} on Plex", "_populate_library")
-                continue
-            for item in library_section.all():
-                external_ids = []
-                try:
-                    external_ids = [guid.id for guid in item.guids]
-                except AttributeError:
-                    pass
-                small_media_item = SmallMediaItem(title=item.title,
-                                                  year=(None if library_section.type == 'artist' else item.year),
-                                                  rating_key=item.ratingKey,
-                                                  library_section_id=item.librarySectionID,
-                                                  media_type=item.type,
-                                                  external_ids=external_ids)
-                small_media_item.add_to_database(database=self.database)
-                bar.next()
-            bar.finish()
-
-    def populate_libraries(self):
-        self.clean_libraries()
-        for group_name in self.library_config.keys():
-            self._populate_library(library_name=group_name)
-
-    def get_user_history(self, username, section_ids):
-        return self.tautulli.get_user_history(username=username, section_ids=section_ids)
+                raise NotFound(f"no library section {library_number}")
+            watermark = None if full_scan else previous_watermark
+            newest_timestamp = previous_watermark or 0
+            changed_rating_keys = set()
+            seen_rating_keys = set()
+            chunk = []
+            for item in self._iter_section_items(library_section=library_section, updated_since=watermark):
+                if stop.is_set():
+                    raise _ScanCancelled()
+                chunk.append(item)
+                seen_rating_keys.add(item.rating_key)
+                if item.updated_at:
+                    newest_timestamp = max(newest_timestamp, item.updated_at)
+                if not (item.updated_at and previous_watermark) or item.updated_at > previous_watermark:
+                    changed_rating_keys.add(item.rating_key)
+                if len(chunk) >= self.sync_chunk_size:
+                    _put_write(writes=writes, stop=stop, write=("chunk", library_number, chunk))
+                    chunk = []
+            if chunk:
+                _put_write(writes=writes, stop=stop, write=("chunk", library_number, chunk))
+            if watermark is None:
+                on_plex_rating_keys = seen_rating_keys  # already walked the whole section
+            else:
+                on_plex_rating_keys = self._get_section_rating_keys(library_section=library_section)
+            result = _SectionScan(full_scan=full_scan, newest_timestamp=newest_timestamp,
+                                  changed_rating_keys=changed_rating_keys, on_plex_rating_keys=on_plex_rating_keys,
+                                  fetch_seconds=time.perf_counter() - start_time)
+        except _ScanCancelled:
+            return
+        except Exception as e:
+            self._error_and_analytics(f"Could not scan library {library_number} on Plex: {e}", "_scan_section")
+        try:
+            _put_write(writes=writes, stop=stop, write=("done", library_number, result))
+        except _ScanCancelled:
+            pass
+
+    def _finish_section(self, library_number: int, scan: '_SectionScan', synced_count: int) -> set:
+        """
+        Work out a scanned section's removals (database writer)
+
+        :return: rating keys removed from the section
+        """
+        # Anything no longer in the section has been removed from Plex
+        removed_rating_keys = self.database.get_rating_keys_for_library(library_section_id=library_number) \
+            - scan.on_plex_rating_keys
+        rate = synced_count / scan.fetch_seconds if scan.fetch_seconds else 0
+        info(f"Staged {synced_count} items ({'full' if scan.full_scan else 'incremental'}), "
+             f"{len(removed_rating_keys)} removed items from library {library_number} "
+             f"(fetched in {scan.fetch_seconds:.1f}s, {rate:.0f} rows/sec)")
+        return removed_rating_keys
+
+    def populate_libraries(self, full_rescan: bool = False):
+        """
+        Sync the configured libraries into the database.
+        Only items updated since the last sync are fetched, unless a full rescan is requested or due.
+        Sections are fetched from Plex concurrently; this thread does all the database writes as chunks arrive.
+        Chunks go to staging tables and are merged into content in one transaction at the end,
+        so recommendations never see a half-synced library.
+
+        :param full_rescan: re-walk every item in every library
+        :return:
+        """
+        self.invalidate_server_metadata()  # pick up added/removed sections
+        library_numbers = list(dict.fromkeys(int(library_number) for library_numbers in self.library_config.values()
+                                             for library_number in library_numbers))
+        writes = queue.Queue(maxsize=self.scan_workers * 4)  # backpressure if writing falls behind
+        stop = threading.Event()
+        synced_counts = {library_number: 0 for library_number in library_numbers}
+        changed_rating_keys = set()
+        removed_rating_keys = set()
+        library_sync_statuses = []
+        rescanned = False
+        self.database.begin_staged_sync()
+        start_time = time.perf_counter()
+        # Read everything the scans need up front, so nothing can fail between starting a scanner and reading its writes
+        scan_plans = []
+        for library_number in library_numbers:
+            library = self.database.get_library(plex_id=library_number)
+            scan_plans.append((library_number,
+                               full_rescan or self._needs_full_rescan(library_number=library_number),
+                               library.LastUpdatedAt if library else None))
+        with ThreadPoolExecutor(max_workers=self.scan_workers, thread_name_prefix="section-scan") as scanners:
+            for library_number, full_scan, previous_watermark in scan_plans:
+                scanners.submit(self._scan_section, library_number=library_number, full_scan=full_scan,
+                                previous_watermark=previous_watermark, writes=writes, stop=stop)
+            remaining = len(library_numbers)
+            try:
+                while remaining:
+                    kind, library_number, payload = writes.get()
+                    if kind == "chunk":
+                        synced_counts[library_number] += self.database.stage_content(contents=payload)
+                        continue
+                    remaining -= 1
+                    if payload:
+                        rescanned = rescanned or payload.full_scan
+                        section_removed = self._finish_section(library_number=library_number, scan=payload,
+                                                               synced_count=synced_counts[library_number])
+                        removed_rating_keys |= section_removed
+                        changed_rating_keys |= payload.changed_rating_keys | section_removed
+                        library_sync_statuses.append((library_number, payload.newest_timestamp,
+                                                      int(time.time()) if payload.full_scan else None))
+            except BaseException:
+                # Scanners blocked on a full queue would keep the executor from ever shutting down
+                stop.set()
+                _drain(writes=writes)
+                raise
+        self.database.apply_staged_sync(removed_rating_keys=list(removed_rating_keys),
+                                        library_sync_statuses=library_sync_statuses)
+        info(f"Synced {len(library_numbers)} libraries in {time.perf_counter() - start_time:.1f}s")
+        if rescanned:
+            self.clean_libraries()
+        self.rebuild_sampling_index()
+        self._list_matches.clear()
+        for rating_key in changed_rating_keys:
+            self._media_items.invalidate(int(rating_key))
+        for callback in self._sync_listeners:
+            callback(changed_rating_keys)
+
+    def enrich_ratings(self, batch_size: int = 50) -> int:
+        """
+        Store IMDb ratings for content that doesn't have one yet
+
+        :param batch_size:
+        :return: number of content items checked
+        """
+        ratings = self._look_up_ratings(contents=self.database.get_contents_needing_rating(count=batch_size))
+        self.database.set_content_ratings(ratings=ratings)
+        return len(ratings)
+
+    def rate_contents(self, content_ids: List[int]) -> List[Tuple[int, Optional[float], Optional[int]]]:
+        """
+        Look up and store the IMDb ratings of specific content items now, rather than waiting for enrich_ratings
+
+        :param content_ids:
+        :return: (content ID, rating, votes) for each item checked, rating and votes may be None
+        """
+        ratings = self._look_up_ratings(contents=self.database.get_contents_to_rate(content_ids=content_ids))
+        self.database.set_content_ratings(ratings=ratings)
+        return ratings
+
+    def _look_up_ratings(self, contents: List[Tuple[int, str, int, Optional[str]]]) \
+            -> List[Tuple[int, Optional[float], Optional[int]]]:
+        """
+        Resolve content items by their IMDb GUID, or by title and year for items without one (i.e. from legacy agents).
+        Items whose lookup fails are left out, so they stay unchecked and are tried again later.
+
+        :param contents: (content ID, title, year, IMDb GUID or None) tuples
+        :return: (content ID, rating, votes) tuples, rating and votes may be None
+        """
+        ratings = []
+        checked_ids = set()
+        for content_id, title, year, imdb_guid in contents:
+            if content_id in checked_ids:
+                continue  # more than one IMDb GUID
+            checked_ids.add(content_id)
+            try:
+                if imdb_guid:
+                    imdb_item = imdb.get_imdb_item_by_id(imdb_id=imdb_guid.replace('imdb://', ''),
+                                                         analytics=self.analytics, raise_errors=True)
+                else:
+                    imdb_item = imdb.get_imdb_item(title, year=year, analytics=self.analytics, raise_errors=True)
+            except Exception:
+                continue  # already logged
+            ratings.append((content_id,
+                            imdb_item.rating if imdb_item else None,
+                            imdb_item.votes if imdb_item else None))
+        return ratings
+
+    def sync_user_history(self, username: str):
+        """
+        Mirror a user's new Tautulli plays into the local watch history, at most once per TTL
+
+        :param username:
+        :return: the user's ID, or None if the user doesn't exist
+        """
+        user_id = self.tautulli.get_user_id(username=username)
+        if user_id is None:
+            self._error_and_analytics(error_message="I couldn't find that username. Please check and try again.",
+                                      function_name='sync_user_history (No Username Match)')
+            return None
+        with self._history_locks_lock:
+            history_lock = self._history_locks.setdefault(user_id, threading.Lock())
+        with history_lock:
+            if self._fresh_history_users.get(user_id) is None:
+                plays = self.tautulli.get_new_plays(user_id=user_id,
+                                                    since=self.database.get_last_watched_at(user_id=user_id))
+                self.database.add_watch_history(user_id=user_id, plays=plays)
+                self._fresh_history_users.set(user_id, True)
+        return user_id
+
+    def invalidate_server_metadata(self):
+        """
+        Forget the cached library sections and clients, so the next lookup asks Plex again
+        """
+        self._sections.clear()
+        self._clients.clear()
+
+    def _get_sections(self) -> dict:
+        sections = self._sections.get('by_id')
+        if sections is None:
+            # A fresh Library, PlexServer.library keeps its sections for as long as the server object lives
+            library = Library(self.server, self.server.query(Library.key))
+            sections = {int(section.key): section for section in library.sections()}
+            self._sections.set('by_id', sections)
+        return sections
+
+    def get_clients(self) -> list:
+        clients = self._clients.get('clients')
+        if clients is None:
+            clients = self.server.clients()
+            self._clients.set('clients', clients)
+        return clients
 
     def get_available_players(self, media_type):
         self.owner_players = []
-        players = self.server.clients()
+        players = self.get_clients()
         if not players:
             return None, 0
         num = 0
@@ -183,20 +537,44 @@ class PlexConnector:
     def play_media(self, player_number, media_item):
         self.owner_players[player_number].goToMedia(media_item)
 
-    def get_library_section(self, section_id):
-        return self.server.library.sectionByID(f"{section_id}")
+    def get_library_section(self, section_id) -> Optional[LibrarySection]:
+        return self._get_sections().get(int(section_id))
 
-    def get_full_media_item(self, content_media_item: Content = None, small_media_item: SmallMediaItem = None,
-                            match_keys: bool = True):
+    def get_library_section_by_name(self, section_name: str) -> Optional[LibrarySection]:
+        for section in self._get_sections().values():
+            if section.title.lower().strip() == section_name.lower().strip():
+                return section
+        return None
+
+    def _fetch_media_item(self, rating_key: int):
+        """
+        Get a PlexAPI item straight from /library/metadata/{ratingKey}
+
+        :param rating_key:
+        :return: None if Plex no longer has an item with that key
+        """
+        media_item = self._media_items.get(int(rating_key))
+        if media_item is None:
+            try:
+                media_item = self.server.fetchItem(int(rating_key))
+            except NotFound:
+                return None
+            self._media_items.set(int(rating_key), media_item)
+        return media_item
+
+    def _search_media_item(self, content_media_item: Content = None, small_media_item: SmallMediaItem = None,
+                           match_keys: bool = True):
         library_section = self.get_library_section(
             section_id=content_media_item.LibraryID if content_media_item else small_media_item.library_section_id)
         if not library_section:
             return None
         for item in get_possible_matching_items(library_section=library_section,
                                                 title=content_media_item.Title if content_media_item else small_media_item.title,
-                                                year=content_media_item.Year if content_media_item else None,
-                                                external_ids=self.database.get_external_ids_for_content(
-                                                    content_id=content_media_item.ID) if content_media_item else small_media_item.external_ids
+                                                year=content_media_item.Year if content_media_item else small_media_item.year,
+                                                external_ids=[e.ExternalID for e in
+                                                              self.database.get_external_ids_for_content(
+                                                                  content_id=content_media_item.ID)]
+                                                if content_media_item else small_media_item.external_ids
                                                 ):
             if match_keys:
                 if item.ratingKey == (
@@ -206,27 +584,53 @@ class PlexConnector:
                 return item  # go with the first item in the list
         return None
 
+    def get_full_media_item(self, content_media_item: Content = None, small_media_item: SmallMediaItem = None,
+                            match_keys: bool = True):
+        """
+        Get the PlexAPI item for a stored content item.
+        Fetched directly by rating key when there is one; searched for by external IDs or title otherwise,
+        or if the stored key has gone stale (in which case the stored key is updated).
+
+        :param content_media_item:
+        :param small_media_item:
+        :param match_keys: when searching, only accept an item with the same rating key
+        :return:
+        """
+        rating_key = content_media_item.RatingKey if content_media_item else small_media_item.rating_key
+        if rating_key:
+            media_item = self._fetch_media_item(rating_key=rating_key)
+            if media_item:
+                return media_item
+            if not content_media_item:
+                return None
+            # Re-added on Plex under a new key, find it again
+            media_item = self._search_media_item(content_media_item=content_media_item, match_keys=False)
+            if media_item:
+                info(f"Rating key for {content_media_item.Title} changed from {rating_key} to {media_item.ratingKey}")
+                self.database.replace_rating_key(content_id=content_media_item.ID, rating_key=media_item.ratingKey)
+                self._media_items.set(int(media_item.ratingKey), media_item)
+            return media_item
+        return self._search_media_item(content_media_item=content_media_item, small_media_item=small_media_item,
+                                       match_keys=match_keys)
+
     @property
     def server_id(self):
         return self.server.machineIdentifier
 
-    def is_on_plex(self, title: str, year: int, external_ids: List[str] = None, section_id: int = None,
-                   section_name: str = None, match_rating_keys: bool = False):
-        sections_ids_to_check = []
-        if section_id:
-            sections_ids_to_check.append(section_id)
-        elif section_name:
-            section = self.server.library.section(title=section_name)
-            if section:
-                sections_ids_to_check.append(section.key)
-        if not sections_ids_to_check:
-            for _, numbers in self.library_config.items():
-                for number in numbers:
-                    sections_ids_to_check.append(number)
-        for s_id in sections_ids_to_check:
-            temp_media_item = SmallMediaItem(title=title, year=year, rating_key=None,
-                                             library_section_id=s_id, media_type=None, external_ids=external_ids)
-            possible_match = self.get_full_media_item(small_media_item=temp_media_item, match_keys=match_rating_keys)
-            if possible_match:
-                return possible_match
-        return False
+    def get_list_matches(self, list_key, get_external_ids: Callable[[], List[str]],
+                         section_ids: List[int] = None) -> List[int]:
+        """
+        Get the IDs of every content item that matches an external list, joining the whole list at once.
+        Results are cached per list until the next library sync.
+
+        :param list_key: identifies the list (and any filters) in the cache
+        :param get_external_ids: returns the Plex GUIDs of every list item, only called on a cache miss
+        :param section_ids: only look in these library sections
+        :return:
+        """
+        content_ids = self._list_matches.get(list_key)
+        if content_ids is None:
+            content_ids = self.database.get_content_ids_by_external_ids(external_ids=get_external_ids(),
+                                                                        library_section_ids=section_ids)
+            self._list_matches.set(list_key, content_ids)
+        return content_ids
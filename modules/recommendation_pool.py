@@ -0,0 +1,86 @@
+import threading
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from discord import Embed
+
+from modules.library_database import Content
+
+ReadyRecommendation = Tuple[Content, Embed]
+
+
+class RecommendationPool:
+    """
+    Per-media-type buffers of random recommendations with their embeds already built
+    """
+
+    def __init__(self, size_per_type: int = 5):
+        self.size_per_type = size_per_type
+        self.hits = 0
+        self.misses = 0
+        self._buffers: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def _buffer(self, media_type: str) -> deque:
+        with self._lock:
+            return self._buffers.setdefault(media_type, deque())
+
+    def pop(self, media_type: str) -> Optional[ReadyRecommendation]:
+        """
+        Take a ready recommendation, if there is one
+
+        :param media_type: library group (i.e. 'movie', '4k', 'music')
+        :return: (content, embed), or None if the buffer is empty
+        """
+        buffer = self._buffer(media_type=media_type)
+        with self._lock:
+            ready = buffer.popleft() if buffer else None
+            if ready:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return ready
+
+    def refill(self, media_type: str, get_contents: Callable[[int], List[Content]],
+               make_embed: Callable[[Content], Embed]) -> int:
+        """
+        Top a buffer back up to size_per_type
+
+        :param media_type: library group (i.e. 'movie', '4k', 'music')
+        :param get_contents: returns up to the given number of random content items
+        :param make_embed: builds the embed for a content item
+        :return: number of recommendations added
+        """
+        buffer = self._buffer(media_type=media_type)
+        with self._lock:
+            missing = self.size_per_type - len(buffer)
+        if missing <= 0:
+            return 0
+        added = 0
+        for content in get_contents(missing):
+            embed = make_embed(content)  # slow, built outside the lock
+            with self._lock:
+                if len(buffer) >= self.size_per_type:
+                    break  # topped up by another refill meanwhile
+                if any(queued.RatingKey == content.RatingKey for queued, _ in buffer):
+                    continue
+                buffer.append((content, embed))
+            added += 1
+        return added
+
+    def discard(self, rating_keys: Iterable[int]):
+        """
+        Drop ready recommendations for items a library sync changed or removed
+        """
+        rating_keys = set(rating_keys)
+        with self._lock:
+            for buffer in self._buffers.values():
+                kept = [ready for ready in list(buffer) if ready[0].RatingKey not in rating_keys]
+                buffer.clear()
+                buffer.extend(kept)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = {'hits': self.hits, 'misses': self.misses}
+            stats.update({f"ready_{media_type}": len(buffer) for media_type, buffer in self._buffers.items()})
+        return stats
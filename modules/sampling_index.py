@@ -0,0 +1,64 @@
+import random
+from array import array
+from typing import Dict, Iterable, List, Tuple
+
+
+class SamplingIndex:
+    """
+    In-memory index of content IDs, keyed by media type and by library, for constant-time random picks
+    """
+
+    def __init__(self):
+        self._by_media_type: Dict[str, array] = {}
+        self._by_library: Dict[int, array] = {}
+
+    def rebuild(self, rows: Iterable[Tuple[int, str, int]]):
+        """
+        Replace the index contents
+
+        :param rows: (content ID, media type, library ID) for every content item that can be recommended
+        :return:
+        """
+        by_media_type = {}
+        by_library = {}
+        for content_id, media_type, library_id in rows:
+            by_media_type.setdefault(media_type, array('q')).append(content_id)
+            by_library.setdefault(int(library_id), array('q')).append(content_id)
+        # Swap in whole so readers never see a half-built index
+        self._by_media_type, self._by_library = by_media_type, by_library
+
+    def _pools(self, media_type: str = None, library_ids: List[int] = None) -> List[array]:
+        if library_ids:
+            by_library = self._by_library
+            return [by_library[int(library_id)] for library_id in library_ids if int(library_id) in by_library]
+        pool = self._by_media_type.get(media_type)
+        return [pool] if pool else []
+
+    def size(self, media_type: str = None, library_ids: List[int] = None) -> int:
+        return sum(len(pool) for pool in self._pools(media_type=media_type, library_ids=library_ids))
+
+    def sample(self, media_type: str = None, library_ids: List[int] = None, count: int = 1) -> List[int]:
+        """
+        Get up to count distinct random content IDs
+
+        :param media_type: Plex media type (i.e. 'movie', 'show', 'artist')
+        :param library_ids: Plex library section IDs, takes precedence over media_type
+        :param count:
+        :return:
+        """
+        pools = self._pools(media_type=media_type, library_ids=library_ids)
+        total = sum(len(pool) for pool in pools)
+        if not total:
+            return []
+        if len(pools) == 1:
+            return random.sample(pools[0], min(count, total))
+        # Draw positions across the combined pools so every item is equally likely
+        content_ids = []
+        for position in sorted(random.sample(range(total), min(count, total))):
+            for pool in pools:
+                if position < len(pool):
+                    content_ids.append(pool[position])
+                    break
+                position -= len(pool)
+        random.shuffle(content_ids)
+        return content_ids
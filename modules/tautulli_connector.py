@@ -1,36 +1,56 @@
-from typing import List
+from typing import List, Tuple
 
+import requests
 import tautulli
 
+from modules.cache import LRUCache
 from modules.logs import *
 
 
 class TautulliConnector:
-    def __init__(self, url, api_key, analytics):
+    def __init__(self, url, api_key, analytics, user_ttl_minutes: int = 10, history_page_size: int = 1000,
+                 session: requests.Session = None):
         self.api = tautulli.ObjectAPI(base_url=url, api_key=api_key)
+        if session:
+            # ObjectAPI has no session parameter, swap out the requests session under its objectrest wrapper
+            self.api._raw_api._session._session = session
         self.analytics = analytics
+        self.history_page_size = history_page_size
+        self._user_ids = LRUCache(max_size=1000, ttl_seconds=user_ttl_minutes * 60)
 
     def _error_and_analytics(self, error_message, function_name):
         error(error_message)
         self.analytics.event(event_category="Error", event_action=function_name, random_uuid_if_needed=True)
 
-    def get_library(self, library_number: int):
-        return self.api.get_library(section_id=str(library_number))
-
-    def get_user_history(self, username: str, section_ids: List[int]):
-        user = None
-        users = self.api.users
-        for _user in users:
-            if user.username == username:
-                user = _user
-                break
-        if not user:
-            self._error_and_analytics(error_message="I couldn't find that username. Please check and try again.",
-                                      function_name='get_user_history (No Username Match)')
-            return "Error"
-        watched_titles = []
-        for section_id in section_ids:
-            section_history = self.api.get_history(user_id=user.user_id, section_id=section_id)
-            for item in section_history.data:
-                watched_titles.append(item.full_title)
-        return watched_titles
+    def get_user_id(self, username: str):
+        user_id = self._user_ids.get(username)
+        if user_id is None:
+            for user in self.api.users:
+                self._user_ids.set(user.username, user.user_id)
+                if user.username == username:
+                    user_id = user.user_id
+        return user_id
+
+    def get_new_plays(self, user_id: int, since: int = 0) -> List[Tuple[int, int]]:
+        """
+        Get a user's plays newer than a given time, paging through history newest-first
+
+        :param user_id:
+        :param since: epoch seconds, plays at or before this are skipped
+        :return: (rating key, played at) pairs, including parent/grandparent keys (seasons, shows, albums, artists)
+        """
+        plays = []
+        start = 0
+        while True:
+            page = self.api.get_history(user_id=user_id, order_column='date', order_direction='desc',
+                                        start=start, length=self.history_page_size)
+            entries = page.data or []
+            for entry in entries:
+                if entry.date and entry.date <= since:
+                    return plays
+                for rating_key in [entry.rating_key, entry.parent_rating_key, entry.grandparent_rating_key]:
+                    if rating_key:
+                        plays.append((int(rating_key), entry.date or 0))
+            if len(entries) < self.history_page_size:
+                return plays
+            start += self.history_page_size
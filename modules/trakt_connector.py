@@ -1,13 +1,38 @@
 import inspect
 import json
+import os
+import time
+from typing import List, NamedTuple, Optional
 
+import requests
 import trakt
 import trakt.core
+from trakt.core import get
 from trakt.users import User
+from trakt.utils import slugify
 
 from modules.logs import *
 
 
+class TraktListItem(NamedTuple):
+    title: str
+    year: int
+    ids: dict  # i.e. {'imdb': 'tt0111161', 'tmdb': 278, 'trakt': 234, 'slug': '...'}
+
+
+class TraktListSnapshot(NamedTuple):
+    updated_at: str
+    items: List[TraktListItem]
+    checked_at: float  # time.monotonic() of the last revalidation
+
+
+@get
+def _fetch_list_items(username: str, list_slug: str):
+    # Raw items, trakt.users.UserList.get_items builds objects that make one more request per item for their IDs
+    data = yield f'users/{slugify(username)}/lists/{list_slug}/items'
+    yield data
+
+
 def get_stored_oauth_token(filename):
     try:
         with open(filename, 'r') as f:
@@ -35,10 +60,16 @@ def sign_in(username: str, client_id: str = None, client_secret: str = None, app
 
 class TraktConnector:
     def __init__(self, username: str, analytics, client_id: str = None, client_secret: str = None, application_id=None,
-                 stay_logged_in: bool = True):
+                 stay_logged_in: bool = True, snapshot_folder: str = "trakt_lists", revalidate_minutes: int = 15,
+                 session: requests.Session = None):
         self.username = username
         self.lists = []
         self.analytics = analytics
+        self.snapshot_folder = snapshot_folder
+        self.revalidate_seconds = revalidate_minutes * 60
+        self._snapshots = {}  # "username/listname" -> TraktListSnapshot
+        if session:
+            trakt.core.session = session  # module-wide, used for every Trakt request (including sign-in)
         sign_in(username=username, client_id=client_id, client_secret=client_secret, application_id=application_id,
                 stay_logged_in=stay_logged_in)
 
@@ -75,7 +106,95 @@ class TraktConnector:
                                   function_name='get_list (trakt)')
         return None
 
-    def get_list_items(self, list_name: str, trakt_username: str = None):
-        trakt_list = self.get_list(list_name=list_name, trakt_username=trakt_username)
-        print(trakt_list)
-        return trakt_list.get_items()
+    def _get_list_summary(self, list_name: str, trakt_username: str):
+        # One request for every list the user has, without their items
+        trakt_user = self.get_trakt_user(username=trakt_username)
+        if not trakt_user:
+            return None
+        for user_list in trakt_user.lists:
+            if list_name in [user_list.name, user_list.slug]:
+                return user_list
+        return None
+
+    def _snapshot_path(self, snapshot_key: str) -> str:
+        return os.path.join(self.snapshot_folder, f"{slugify(snapshot_key.replace('/', '__'))}.json")
+
+    def _read_snapshot(self, snapshot_key: str) -> Optional[TraktListSnapshot]:
+        try:
+            with open(self._snapshot_path(snapshot_key=snapshot_key), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        items = [TraktListItem(title=item['title'], year=item['year'], ids=item['ids']) for item in data['items']]
+        return TraktListSnapshot(updated_at=data['updated_at'], items=items, checked_at=0.0)
+
+    def _write_snapshot(self, snapshot_key: str, snapshot: TraktListSnapshot):
+        os.makedirs(self.snapshot_folder, exist_ok=True)
+        path = self._snapshot_path(snapshot_key=snapshot_key)
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump({'updated_at': snapshot.updated_at, 'items': [item._asdict() for item in snapshot.items]}, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _keep_stale_snapshot(self, snapshot_key: str, snapshot: Optional[TraktListSnapshot]):
+        """
+        Serve a snapshot that couldn't be revalidated until the next revalidation window (stale is better than nothing),
+        rather than asking Trakt again on every request
+        """
+        if snapshot:
+            snapshot = snapshot._replace(checked_at=time.monotonic())
+            self._snapshots[snapshot_key] = snapshot
+        return snapshot
+
+    def get_list_snapshot(self, list_name: str, trakt_username: str = None) -> Optional[TraktListSnapshot]:
+        """
+        Get a list's items from the local snapshot, only downloading them again if the list changed on Trakt
+
+        :param list_name:
+        :param trakt_username:
+        :return:
+        """
+        if not trakt_username:
+            trakt_username = self.get_username_by_listname(list_name=list_name)
+        if not trakt_username:
+            self._error_and_analytics(error_message="Could not locate corresponding Trakt user.",
+                                      function_name='get_list_snapshot (trakt)')
+            return None
+        snapshot_key = f"{trakt_username}/{list_name}"
+        snapshot = self._snapshots.get(snapshot_key) or self._read_snapshot(snapshot_key=snapshot_key)
+        if snapshot and time.monotonic() - snapshot.checked_at < self.revalidate_seconds:
+            return snapshot
+
+        try:
+            summary = self._get_list_summary(list_name=list_name, trakt_username=trakt_username)
+            if not summary:
+                self._error_and_analytics(error_message=f"Could not find Trakt list {snapshot_key}",
+                                          function_name='get_list_snapshot (trakt)')
+                return self._keep_stale_snapshot(snapshot_key=snapshot_key, snapshot=snapshot)
+            if snapshot and snapshot.updated_at == str(summary.updated_at):
+                snapshot = snapshot._replace(checked_at=time.monotonic())
+            else:
+                info(f"Downloading Trakt list {snapshot_key}...")
+                items = []
+                for entry in _fetch_list_items(trakt_username, summary.slug):
+                    if entry.get('type') not in ['movie', 'show']:
+                        continue  # seasons, episodes and people can't be recommended
+                    item = entry[entry['type']]
+                    if 'ids' in item:
+                        items.append(TraktListItem(title=item.get('title'), year=item.get('year'), ids=item['ids']))
+                snapshot = TraktListSnapshot(updated_at=str(summary.updated_at), items=items,
+                                             checked_at=time.monotonic())
+                self._write_snapshot(snapshot_key=snapshot_key, snapshot=snapshot)
+        except Exception as e:
+            self._error_and_analytics(error_message=f"Error in get_list_snapshot: {e}",
+                                      function_name=inspect.currentframe().f_code.co_name)
+            return self._keep_stale_snapshot(snapshot_key=snapshot_key, snapshot=snapshot)
+        self._snapshots[snapshot_key] = snapshot
+        return snapshot
+
+    def warm_list_snapshots(self):
+        """
+        Load or refresh the snapshot of every configured list
+        """
+        for trakt_username, list_names in self.lists.items():
+            for list_name in list_names:
+                self.get_list_snapshot(list_name=list_name, trakt_username=trakt_username)
@@ -0,0 +1,34 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class _TimeoutSession(requests.Session):
+    def __init__(self, timeout: float):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+def build_session(pool_size: int = 10, timeout: float = 30, max_retries: int = 3,
+                  retry_backoff: float = 0.5) -> requests.Session:
+    """
+    Build an HTTP session to share between every connector, so connections to each host are kept alive and reused
+
+    :param pool_size: connections kept open per host
+    :param timeout: seconds, for requests that don't set their own
+    :param max_retries: retries for connection errors and 429/5xx responses (idempotent methods only)
+    :param retry_backoff: retries wait retry_backoff * 2^(retry number - 1) seconds
+    :return:
+    """
+    session = _TimeoutSession(timeout=timeout)
+    retry = Retry(total=max_retries, backoff_factor=retry_backoff, status_forcelist=[429, 500, 502, 503, 504],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session